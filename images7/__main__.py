@@ -57,7 +57,7 @@ if __name__ == '__main__':
         clean_cut,
     )
     from .analyse import exif
-    from .job.transcode import imageproxy
+    from .job.transcode import imageproxy, previewproxy  # noqa: F401 (registers the transcoders)
 
     # Config
     logging.info("*** Reading config from %s.", args.config)
@@ -1,9 +1,17 @@
 _mime_map = {}
+_header_mime_map = {}
 
 
-def register_analyser(mime_type, module):
+def register_analyser(mime_type, module, from_header=False):
     _mime_map[mime_type] = module
+    if from_header:
+        _header_mime_map[mime_type] = module
 
 
 def get_analyser(mime_type):
     return _mime_map.get(mime_type, None)
+
+
+def get_header_analyser(mime_type):
+    """Analysers that can work from the first bytes of a file only."""
+    return _header_mime_map.get(mime_type, None)
@@ -7,8 +7,11 @@ from images7.entry import DefaultEntryMetadata
 
 def read_exif(path):
     exif = None
-    with open(path, 'rb') as f:
-        exif = exifread.process_file(f)
+    if hasattr(path, 'read'):
+        exif = exifread.process_file(path)
+    else:
+        with open(path, 'rb') as f:
+            exif = exifread.process_file(f)
 
     # Orientation (rotation)
     orientation, mirror, angle = exif_orientation(exif)
@@ -45,7 +48,8 @@ def read_exif(path):
     })
 
 
-register_analyser('image/jpeg', read_exif)
+# The EXIF segment of a JPEG lives in APP1 before the image data
+register_analyser('image/jpeg', read_exif, from_header=True)
 register_analyser('image/tiff', read_exif)
 register_analyser('image/png', read_exif)
 
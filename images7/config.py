@@ -40,6 +40,7 @@ class SystemConfig(PropertySet):
 class DatabaseConfig(PropertySet):
     server = Property()
     path = Property()
+    engine = Property(default='jsondb')
 
     @classmethod
     def FromUrl(cls, query):
@@ -204,6 +205,8 @@ class JobConfig(PropertySet):
         inst.name = query.netloc
         inst.settings = get_schema(get_schema_name(inst.name))()
         for key, value in parse_qsl(query.query):
+            if key == 'process': value = value.split()
+            if key in ('processes', 'io_per_device'): value = int(value)
             setattr(inst.settings, key, value)
         return inst
 
@@ -220,8 +223,15 @@ class FlickrJobSettings(PropertySet):
     key = Property()
 
 
+class DispatchJobSettings(PropertySet):
+    processes = Property(int)
+    process = Property(list)
+    io_per_device = Property(int, default=2)
+
+
 register_schema(ImportJobSettings)
 register_schema(FlickrJobSettings)
+register_schema(DispatchJobSettings)
 
 
 class Config(PropertySet):
@@ -296,7 +306,7 @@ class Config(PropertySet):
             or next((s for s in self.drops if s.name == name), None)
     
     def get_job_settings(self, name):
-        return next((s.settings for s in self.jobs), None)
+        return next((s.settings for s in self.jobs if s.name == name), None)
 
 
 if __name__ == '__main__':
@@ -3,6 +3,8 @@ import bottle
 import datetime
 import urllib
 import json
+import threading
+from jsondb import Conflict
 from jsonobject import PropertySet, Property, EnumProperty
 
 from .system import current_system
@@ -95,6 +97,7 @@ class Date(PropertySet):
 
 class DateFeed(PropertySet):
     count = Property(int)
+    stats = Property(DateStats)
     entries = Property(Date, is_list=True)
 
 
@@ -136,20 +139,26 @@ def get_dates(query=None):
 
     logging.info(query.to_query_string())
     if query.month is not None:
+        period = '%04i-%02i' % (query.year, query.month)
         sk = (query.year, query.month)
         ek = (query.year, query.month, any)
     elif query.year is not None:
+        period = '%04i' % query.year
         sk = (query.year, )
         ek = (query.year, any)
     else:
+        period = 'all'
         sk = None
         ek = any
     reverse = query.reverse
 
-    date_stats = [(date['key'], DateStats.FromDict(date['value'])) for date
-                  in current_system().db['entry'].view('state_by_date', startkey=sk, endkey=ek, group=True)]
+    ensure_date_stats()
+    stats_db = current_system().db['date_stats']
+    date_stats = [(date['doc']['_id'], DateStats.FromDict(date['doc']['stats'])) for date
+                  in stats_db.view('by_day', startkey=sk, endkey=ek, include_docs=True)]
+    dsk, dek = (None, any) if period == 'all' else (period, period + '-\uffff')
     date_infos = {date.get('key'): Date.FromDict(date['doc']) for date
-                  in current_system().db['date'].view('by_date', startkey=sk, endkey=ek, include_docs=True)}
+                  in current_system().db['date'].view('by_date', startkey=dsk, endkey=dek, include_docs=True)}
     dates = []
     for date_str, date_stat in date_stats:
         try:
@@ -163,6 +172,7 @@ def get_dates(query=None):
     [date.calculate_urls() for date in dates]
     return DateFeed(
         count=len(dates),
+        stats=get_date_stats(period),
         entries=dates if not reverse else list(reversed(dates)),
     )
 
@@ -174,11 +184,7 @@ def get_date(date):
     except KeyError:
         result = Date(date=date)
 
-    try:
-        result.stats = DateStats.FromDict(list(current_system().db['entry'].view('state_by_date', key=date, group=True))[0]['value'])
-    except IndexError:
-        result.stats = DateStats()
-
+    result.stats = get_date_stats(date)
     result.calculate_urls()
     return result
 
@@ -203,3 +209,117 @@ def patch_date(date, patch):
 
 def delete_date(date):
     current_system().db['date'].delete(date)
+
+
+# STATISTICS
+############
+#
+# Entries are counted per state and per day, month and year of taken_ts
+# (documents "2017-06-01", "2017-06", "2017" and "all" in date_stats). The
+# counters are updated every time an entry is created, changed or deleted.
+
+
+_stats_lock = threading.Lock()
+_stats_ready = False
+
+
+def get_date_stats(period):
+    ensure_date_stats()
+    try:
+        return DateStats.FromDict(current_system().db['date_stats'][period]['stats'])
+    except KeyError:
+        return DateStats()
+
+
+def count_entry_change(before, after):
+    """Update the date statistics for an entry going from before to after
+    (entry dicts, None for created or deleted entries)."""
+    old = _date_and_state(before)
+    new = _date_and_state(after)
+    if old == new:
+        return
+
+    global _stats_ready
+    with _stats_lock:
+        if not _stats_ready:
+            if not current_system().db['date_stats'].has('all'):
+                return  # will be counted by ensure_date_stats()
+            _stats_ready = True  # built before a restart, keep counting
+        if old is not None:
+            _count(*old, delta=-1)
+        if new is not None:
+            _count(*new, delta=1)
+
+
+def ensure_date_stats():
+    """Build the statistics from the entry database the first time."""
+    global _stats_ready
+    if _stats_ready:
+        return
+
+    with _stats_lock:
+        db = current_system().db['date_stats']
+        if not db.has('all'):
+            logging.info('Building date statistics...')
+            counts = {}
+            for row in current_system().db['entry'].view('state_by_date', group=True):
+                date = row['key']
+                for period in _periods(date):
+                    stats = counts.setdefault(period, {})
+                    for state, count in row['value'].items():
+                        stats[state] = stats.get(state, 0) + count
+
+            counts.setdefault('all', {})
+            for period, stats in counts.items():
+                _save_stats(period, stats)
+            logging.info('Built date statistics for %i periods.', len(counts))
+
+        _stats_ready = True
+
+
+def _date_and_state(entry):
+    if entry is None:
+        return None
+    metadata = entry.get('metadata') or {}
+    taken_ts = metadata.get('taken_ts')
+    if taken_ts is None:
+        return None
+    return taken_ts[:10], entry.get('state')
+
+
+def _periods(date):
+    return date, date[:7], date[:4], 'all'
+
+
+def _count(date, state, delta):
+    db = current_system().db['date_stats']
+    for period in _periods(date):
+        while True:
+            try:
+                doc = db[period]
+            except KeyError:
+                if delta < 0:
+                    break
+                doc = {'_id': period, 'stats': {}}
+            stats = doc['stats']
+            stats[state] = stats.get(state, 0) + delta
+            stats['total'] = stats.get('total', 0) + delta
+            try:
+                if stats['total'] <= 0 and period != 'all':
+                    db.delete(period)
+                else:
+                    _save_stats(period, stats, doc.get('_rev'))
+            except Conflict:
+                continue
+            break
+
+
+def _save_stats(period, stats, revision=None):
+    doc = {
+        '_id': period,
+        'period': [] if period == 'all' else [int(part) for part in period.split('-')],
+        'stats': stats,
+    }
+    if revision is not None:
+        doc['_rev'] = revision
+    current_system().db['date_stats'].save(doc)
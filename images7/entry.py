@@ -5,7 +5,10 @@ import uuid
 import logging
 import datetime
 import json
+import base64
+import itertools
 import mimetypes
+import threading
 
 from jsonobject import (
     PropertySet,
@@ -18,6 +21,8 @@ from jsonobject import (
 
 from images7.system import current_system
 from images7.files import App as FileApp
+from images7.date import count_entry_change
+from images7.retry import backoff
 from images7.web import (
     Create,
     FetchById,
@@ -204,6 +209,8 @@ class EntryFeed(PropertySet):
     date = Property()
     state = Property(enum=State)
     entries = Property(Entry, is_list=True)
+    after = Property()
+    before = Property()
 
 
 class EntryQuery(Query):
@@ -214,6 +221,8 @@ class EntryQuery(Query):
     state = Property(enum=State)
     delta = Property(int, default=0)
     reverse = Property(bool, default=False)
+    after = Property()
+    before = Property()
 
 
 class StateQuery(Query):
@@ -232,6 +241,8 @@ def get_entries(query=None):
         state = None
         delta = 0
         reverse = False
+        after = None
+        before = None
 
     else:
         offset = query.offset
@@ -240,16 +251,13 @@ def get_entries(query=None):
         delta = query.delta
         reverse = query.reverse
         state = query.state
+        after = query.after
+        before = query.before
 
     if state is not None:
-        entry_data = current_system().db['entry'].view(
-            'by_state_and_taken_ts',
-            startkey=(state.value, None),
-            endkey=(state.value, any),
-            include_docs=True,
-            skip=offset,
-            limit=page_size,
-        )
+        view = 'by_state_and_taken_ts'
+        startkey = (state.value, None)
+        endkey = (state.value, any)
 
     elif date is not None:
         if date == 'today':
@@ -258,25 +266,39 @@ def get_entries(query=None):
             date = (int(part) for part in date.split('-', 2))
             date = datetime.date(*date)
         date += datetime.timedelta(days=delta)
-        entry_data = current_system().db['entry'].view(
-            'by_taken_ts',
-            startkey=(date.year, date.month, date.day),
-            endkey=(date.year, date.month, date.day, any),
-            include_docs=True,
-            skip=offset,
-            limit=page_size,
-        )
+        view = 'by_taken_ts'
+        startkey = (date.year, date.month, date.day)
+        endkey = (date.year, date.month, date.day, any)
+
+    else:
+        view = 'by_taken_ts'
+        startkey = None
+        endkey = None
+
+    db = current_system().db['entry']
+    if after is not None:
+        key, id = decode_cursor(after)
+        rows = db.view(view, startkey=key, endkey=endkey, include_docs=True)
+        rows = itertools.dropwhile(lambda row: row['key'] == key and row['_id'] <= id, rows)
+        rows = list(itertools.islice(rows, page_size))
+
+    elif before is not None:
+        key, id = decode_cursor(before)
+        rows = db.view(view, startkey=key, endkey=startkey, include_docs=True, descending=True)
+        rows = itertools.dropwhile(lambda row: row['key'] == key and row['_id'] >= id, rows)
+        rows = list(reversed(list(itertools.islice(rows, page_size))))
 
     else:
-        entry_data = current_system().db['entry'].view(
-            'by_taken_ts',
+        rows = list(db.view(
+            view,
+            startkey=startkey,
+            endkey=endkey,
             include_docs=True,
             skip=offset,
             limit=page_size,
-        )
-
+        ))
 
-    entries = [Entry.FromDict(entry.get('doc')) for entry in entry_data]
+    entries = [Entry.FromDict(row.get('doc')) for row in rows]
     for entry in entries:
         entry.calculate_urls()
     return EntryFeed(
@@ -285,9 +307,31 @@ def get_entries(query=None):
         count=len(entries),
         offset=offset,
         entries=entries if not reverse else list(reversed(entries)),
+        after=encode_cursor(rows[-1]) if rows else None,
+        before=encode_cursor(rows[0]) if rows else None,
     )
 
 
+def encode_cursor(row):
+    """Opaque page cursor pointing at a view row (view key and doc id)."""
+    cursor = json.dumps([row['key'], row['_id']], separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        key, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+    except (ValueError, TypeError):
+        raise bottle.HTTPError(400, 'Bad cursor')
+    return _tuples(key), id
+
+
+def _tuples(value):
+    if isinstance(value, list):
+        return tuple(_tuples(v) for v in value)
+    return value
+
+
 def get_entry_by_id(id) -> Entry:
     entry = Entry.FromDict(current_system().db['entry'][id])
     entry.calculate_urls()
@@ -323,7 +367,14 @@ def get_entries_by_reference(reference):
 def update_entry_by_id(id, entry) -> Entry:
     entry.id = id
     logging.debug('Updating entry to\n%s', entry.to_json())
-    entry = Entry.FromDict(current_system().db['entry'].save(entry.to_dict()))
+    db = current_system().db['entry']
+    try:
+        before = db[id]
+    except KeyError:
+        before = None
+    after = db.save(entry.to_dict())
+    count_entry_change(before, after)
+    entry = Entry.FromDict(after)
     return entry
 
 
@@ -333,13 +384,80 @@ def update_entry_state(id, query):
     except AttributeError:
         raise bottle.HTTPError(400)
 
-    entry = get_entry_by_id(id)
+    return set_entry_state(id, state, only_from=State.pending if query.soft else None)
+
+
+# Atomic mutations. Changes to the same entry are serialized within the
+# process, and conflicts with other writers are retried right away.
+
+_entry_locks = [threading.Lock() for _ in range(64)]
+
+
+def mutate_entry(id, mutation) -> Entry:
+    """
+    Apply mutation to a freshly read entry and save it, again and again
+    until there is no conflict. The mutation may return False to leave
+    the entry unchanged.
+    """
+    with _entry_locks[hash(id) % len(_entry_locks)]:
+        @backoff()
+        def apply():
+            entry = get_entry_by_id(id)
+            if mutation(entry) is False:
+                return entry
+            return update_entry_by_id(id, entry)
+
+        return apply()
+
+
+def append_file_references(id, file_refs) -> Entry:
+    def mutation(entry):
+        entry.files.extend(file_refs)
+    return mutate_entry(id, mutation)
+
 
-    if query.soft and entry.state != State.pending:
-        return entry
+def remove_file_reference(id, reference) -> Entry:
+    def mutation(entry):
+        files = [f for f in entry.files if f.reference != reference]
+        if len(files) == len(entry.files):
+            return False
+        entry.files = files
+    return mutate_entry(id, mutation)
 
-    entry.state = state
-    return update_entry_by_id(id, entry)
+
+def merge_entry_metadata(id, metadata) -> Entry:
+    def mutation(entry):
+        if entry.metadata is None:
+            entry.metadata = metadata
+        else:
+            entry.metadata.merge(metadata)
+    return mutate_entry(id, mutation)
+
+
+def set_entry_state(id, state, only_from=None) -> Entry:
+    def mutation(entry):
+        if only_from is not None and entry.state != only_from:
+            return False
+        entry.state = state
+    return mutate_entry(id, mutation)
+
+
+def add_entry_tags(id, tags) -> Entry:
+    def mutation(entry):
+        new_tags = [tag for tag in tags if tag not in (entry.tags or [])]
+        if not new_tags:
+            return False
+        entry.tags = (entry.tags or []) + new_tags
+    return mutate_entry(id, mutation)
+
+
+def remove_entry_tags(id, tags) -> Entry:
+    def mutation(entry):
+        kept_tags = [tag for tag in (entry.tags or []) if tag not in tags]
+        if len(kept_tags) == len(entry.tags or []):
+            return False
+        entry.tags = kept_tags
+    return mutate_entry(id, mutation)
 
 
 #def patch_entry_metadata_by_id(id, patch):
@@ -384,11 +502,34 @@ def create_entry(ed):
     if ed.id is None:
         ed.id = uuid.uuid4().hex
     logging.debug('Create entry\n%s', ed.to_json())
-    return Entry.FromDict(current_system().select('entry').save(ed.to_dict()))
+    after = current_system().select('entry').save(ed.to_dict())
+    count_entry_change(None, after)
+    return Entry.FromDict(after)
+
+
+def create_entries(entries):
+    db = current_system().select('entry')
+    for ed in entries:
+        if ed.id is None:
+            ed.id = uuid.uuid4().hex
+    docs = [ed.to_dict() for ed in entries]
+    if hasattr(db, 'save_many'):
+        docs = db.save_many(docs)
+    else:
+        docs = [db.save(doc) for doc in docs]
+    for after in docs:
+        count_entry_change(None, after)
+    return [Entry.FromDict(after) for after in docs]
 
 
 def delete_entry_by_id(id):
-    current_system().db['entry'].delete(id)
+    db = current_system().db['entry']
+    try:
+        before = db[id]
+    except KeyError:
+        before = None
+    db.delete(id)
+    count_entry_change(before, None)
 
 
 #def download(id, store, version, extension):
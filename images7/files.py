@@ -54,6 +54,7 @@ class File(PropertySet):
     url = Property(name='_id')
     mime_type = Property()
     status = Property(enum=FileStatus)
+    fingerprint = Property()
 
     @property
     def parsed_url(self):
@@ -76,12 +77,44 @@ def get_file_by_reference(reference):
     return File.FromDict(result['doc'])
 
 
+def get_files_by_reference(reference):
+    files = current_system() \
+        .select('file') \
+        .view('by_reference', include_docs=True, key=reference)
+
+    return [File.FromDict(f['doc']) for f in files]
+
+
+def get_files_by_fingerprint(fingerprint):
+    files = current_system() \
+        .select('file') \
+        .view('by_fingerprint', include_docs=True, key=fingerprint)
+
+    return [File.FromDict(f['doc']) for f in files]
+
+
 def get_file_by_url(url):
     return File.FromDict(
         current_system()
             .select('file')[url])
 
 
+def get_files_by_urls(urls):
+    db = current_system().select('file')
+    if hasattr(db, 'get_many'):
+        docs = db.get_many(urls)
+    else:
+        docs = {url: db[url] for url in urls if db.has(url)}
+    return {url: File.FromDict(doc) for url, doc in docs.items()}
+
+
+def get_existing_urls(urls):
+    db = current_system().select('file')
+    if hasattr(db, 'has_many'):
+        return db.has_many(urls)
+    return {url for url in urls if db.has(url)}
+
+
 def get_urls_by_reference(reference):
     files = current_system() \
         .select('file') \
@@ -97,6 +130,23 @@ def create_file(f):
             .save(f.to_dict()))
 
 
+def create_files(files):
+    db = current_system().select('file')
+    docs = [f.to_dict() for f in files]
+    if hasattr(db, 'save_many'):
+        docs = db.save_many(docs)
+    else:
+        docs = [db.save(doc) for doc in docs]
+    return [File.FromDict(doc) for doc in docs]
+
+
+def update_file(f):
+    return File.FromDict(
+        current_system()
+            .select('file')
+            .save(f.to_dict()))
+
+
 #def download(id, reference, extension=None):
 #    system = current_system()
 #    as_download = bottle.request.query.download == 'yes'
@@ -8,18 +8,23 @@ import base64
 import bottle
 
 from jsonobject import wrap_raw_json
-from threading import Thread, Event, Lock
+from threading import Event, Lock
 from time import sleep
 
-from images7.web import ResourceBusy
+from images7.web import ResourceBusy, FetchById
+from images7.progress import create_progress, get_progress, count
 from images7.system import current_system
-from images7.localfile import FolderScanner
-from images7.job import Job, Step
-from images7.job.register import Register, RegisterPart
+from images7.localfile import FolderScanner, FolderSnapshot
+from images7.files import get_existing_urls
+from images7.job import Job, Step, get_queue_depth
+from images7.job.register import Register, RegisterPart, RegisterStem
 
 from images7.multi import QueueClient
 
 re_clean = re.compile(r'[^A-Za-z0-9_\-\.]')
+CHECK_CHUNK_SIZE = 2000
+IMPORT_WINDOW = 100  # jobs waiting in the queue before the scanner holds back
+REGISTER_BATCH_SIZE = 200  # stems per register job, the scan is checkpointed after each batch
 
 
 # WEB
@@ -29,6 +34,8 @@ re_clean = re.compile(r'[^A-Za-z0-9_\-\.]')
 class App:
     BASE = '/importer'
 
+    importer = None
+
     @classmethod
     def create(self):
         app = bottle.Bottle()
@@ -38,22 +45,30 @@ class App:
             method='POST',
             callback=trig_import,
         )
+        app.route(
+            path='/<id>',
+            callback=FetchById(get_import_progress),
+        )
 
         return app
 
     @classmethod
     def run(cls, **kwargs):
-        importer = Importer()
-        t = Thread(target=importer.run, name='Importer')
-        t.daemon = True
-        t.start()
+        App.importer = Importer()
 
 
 def trig_import():
-    logging.info("Start")
-    current_system().zmq_req_lazy_pirate('trig_import')
-    logging.info("Stop")
-    return {'result': 'ok'}
+    progress = App.importer.trig_import()
+    progress.calculate(App.BASE)
+    return progress.to_dict(include_calculated=True)
+
+
+def get_import_progress(id):
+    progress = get_progress(id)
+    if progress is None:
+        raise bottle.HTTPError(404)
+    progress.calculate(App.BASE)
+    return progress
 
 
 def get_trig_url():
@@ -94,17 +109,23 @@ class Importer:
         cards = [config for config in system.config.cards]
         drops = [config for config in system.config.drops if config.server == system.hostname]
         self.sources = cards + drops
-
-    def run(self):
-        system = current_system()
-        system.zmq_rep_lazy_pirate('trig_import', self.trig_import)
+        self.scanner = None
+        self.lock = Lock()
 
     def trig_import(self):
         logging.info('Received trig_import')
-        t = Scanner('ipc://job_queue', 1)
-        t.sources = self.sources
-        t.start()
-        t.join()
+        with self.lock:
+            if self.scanner is not None and self.scanner.is_alive():
+                logging.info('Already scanning')
+                return self.scanner.progress
+
+            t = Scanner('ipc://job_queue', 1)
+            t.sources = self.sources
+            t.progress = create_progress()
+            t.daemon = True
+            t.start()
+            self.scanner = t
+            return t.progress
 
 
 class Scanner(QueueClient):
@@ -126,6 +147,8 @@ class Scanner(QueueClient):
                 for request in self.run_scan(name, path):
                     yield request
 
+        self.progress.scanned = True
+
     def run_scan(self, name, root_path):
         # Scan the root path for files matching the filter
         system = current_system()
@@ -137,52 +160,125 @@ class Scanner(QueueClient):
         prios = {x: n for (n, x) in enumerate(source.extension)}
         def prio(x): return prios[os.path.splitext(x)[1][1:].lower()]
 
-        scanner = FolderScanner(root_path, extensions=source.extension)
-        collected = {}
-        for file_path in scanner.scan():
-            if not '.' in file_path:
+        snapshot = FolderSnapshot(get_snapshot_path(source.name))
+        scanner = FolderScanner(root_path, extensions=source.extension, snapshot=snapshot)
+        done = read_checkpoint(source.name)
+        if done:
+            logging.info('Resuming %s, %d folders already queued', source.name, len(done))
+
+        # Queue register jobs while scanning, a folder at a time so that all
+        # files of a stem are seen together. The checkpoint lists the folders
+        # whose stems are all queued.
+        queued = 0
+        batch = []
+        batch_folders = []
+        for folder, file_paths in scanner.scan_folders():
+            if folder in done:
                 continue
 
-            url = source.get_path_url(file_path)
-            if system.select('file').has(url):
-                logging.info('Has %s already', url)
+            collected = {}
+            for candidates in _chunks([p for p in file_paths if '.' in p], CHECK_CHUNK_SIZE):
+                urls = {file_path: source.get_path_url(file_path) for file_path in candidates}
+                existing = get_existing_urls(urls.values())
+                logging.debug('Has %d of %d files in %s already', len(existing), len(candidates), folder)
+                # Only files known to be registered are kept in the snapshot, the
+                # ones queued now are confirmed by the next scan if they made it
+                snapshot.confirm(p for p in candidates if urls[p] in existing)
+
+                for file_path in candidates:
+                    if urls[file_path] in existing:
+                        continue
+                    stem, _ = os.path.splitext(file_path)
+                    collected.setdefault(stem, []).append(file_path)
+
+            count(self.progress.id, files_discovered=sum(len(f) for f in collected.values()))
+
+            for stem, stem_paths in sorted(collected.items(), key=lambda x: x[0]):
+                logging.debug("Importing %s", ' + '.join(stem_paths))
+
+                parts = []
+                for file_path in sorted(stem_paths, key=prio):
+                    full_path = os.path.join(root_path, file_path)
+                    mime_type, is_raw = guess_mime_type(full_path)
+
+                    parts.append(RegisterPart(
+                        server=system.hostname,
+                        source=source.name,
+                        root_path=root_path,
+                        path=file_path,
+                        is_raw=is_raw,
+                        mime_type=mime_type,
+                    ))
+
+                batch.append(RegisterStem(parts=parts))
+            batch_folders.append(folder)
+
+            if len(batch) < REGISTER_BATCH_SIZE:
                 continue
 
-            stem, _ = os.path.splitext(file_path)
-            if stem in collected.keys():
-                collected[stem].append(file_path)
-            else:
-                collected[stem] = [file_path]
-
-            if len(collected) >= 100: break
-
-        logging.info('Collected %d files.', len(collected))
-
-        # Create entries and import jobs for each found file
-        for _, file_paths in sorted(collected.items(), key=lambda x: x[0]):
-            logging.debug("Importing %s", ' + '.join(file_paths))
-
-            parts = []
-            for file_path in sorted(file_paths, key=prio):
-                full_path = os.path.join(root_path, file_path)
-                mime_type, is_raw = guess_mime_type(full_path)
-
-                parts.append(RegisterPart(
-                    server=system.hostname,
-                    source=source.name,
-                    root_path=root_path,
-                    path=file_path,
-                    is_raw=is_raw,
-                    mime_type=mime_type,
-                ))
-
-            yield Job(
-                steps=[
-                    Register.AsStep(
-                        parts=parts,
-                    )
-                ]
-            )
+            for stems in _chunks(batch, REGISTER_BATCH_SIZE):
+                yield self.register_job(stems)
+            queued += len(batch)
+            done.update(batch_folders)
+            write_checkpoint(source.name, done)
+            batch = []
+            batch_folders = []
+
+        if batch:
+            yield self.register_job(batch)
+            queued += len(batch)
+
+        logging.info('Queued %d stems from %s.', queued, source.name)
+        snapshot.save()
+        write_checkpoint(source.name, None)
+
+    def register_job(self, stems):
+        while get_queue_depth() >= IMPORT_WINDOW:
+            sleep(0.5)
+
+        count(self.progress.id, jobs_queued=1)
+        return Job(
+            import_id=self.progress.id,
+            steps=[
+                Register.AsStep(
+                    stems=stems,
+                )
+            ]
+        )
+
+
+def get_snapshot_path(name):
+    return os.path.join(current_system().db_root, 'snapshot', name + '.json')
+
+
+def get_checkpoint_path(name):
+    return os.path.join(current_system().db_root, 'snapshot', name + '.checkpoint')
+
+
+def read_checkpoint(name):
+    """The folders queued from the source by an import that did not finish."""
+    path = get_checkpoint_path(name)
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.rstrip('\n') for line in f if line.strip()}
+
+
+def write_checkpoint(name, folders):
+    path = get_checkpoint_path(name)
+    if folders is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        f.writelines(folder + '\n' for folder in sorted(folders))
+    os.replace(path + '.tmp', path)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 def guess_mime_type(file_path):
@@ -4,7 +4,11 @@ import threading
 import time
 import jsondb
 import urllib
+import uuid
+import json
+import struct
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from jsonobject import (
     PropertySet,
@@ -15,8 +19,12 @@ from jsonobject import (
     register_schema,
 )
 
-from images7.multi import QueueServer, QueueWorker, QueueClient
+from images7.multi import QueueServer, QueueWorker, QueueClient, setup_process_pool, set_current_method, setup_device_gate
 from images7.system import current_system
+from images7.progress import count
+from images7.localfile import sync_pending
+from images7.web import Create, FetchById
+from images7.retry import RetryLater
 
 
 # WEB
@@ -26,34 +34,212 @@ from images7.system import current_system
 class App:
     BASE = '/job'
 
+    queue = None
+
     @classmethod
     def create(self):
         app = bottle.Bottle()
 
+        app.route(
+            path='/',
+            method='POST',
+            callback=Create(create_job, Job),
+        )
+        app.route(
+            path='/stats',
+            callback=get_queue_stats,
+        )
+        app.route(
+            path='/<id>',
+            callback=FetchById(get_job_by_id),
+        )
+
         return app
 
     @classmethod
     def run(self, workers=1):
-        queue_thread = QueueServer('ipc://job_queue', Dispatcher, workers=workers)
+        settings = current_system().config.get_job_settings('dispatch')
+        if settings is not None:
+            setup_process_pool(processes=settings.processes, methods=settings.process)
+            setup_device_gate(settings.io_per_device)
+
+        queue_thread = JobQueueServer('ipc://job_queue', Dispatcher, workers=workers)
         queue_thread.start()
+        App.queue = queue_thread
+
+
+def get_queue_stats():
+    if App.queue is None:
+        raise bottle.HTTPError(503)
+    return App.queue.stats()
+
+
+def get_queue_depth():
+    if App.queue is None:
+        return 0
+    return App.queue.depth()
+
+
+class JobQueueServer(QueueServer):
+    """
+    Broker that keeps its queue in the job database instead of in memory.
+
+    Jobs are saved as new when they arrive, and handed out by priority as
+    soon as their release time has passed. Workers get the job id only and
+    read the job from the database.
+
+    A job that does the same work as one still waiting in the queue (see
+    coalesce_key) supersedes it, so that only the latest of them runs.
+    """
+
+    poll_timeout = 1000  # ms, to pick up jobs whose release time has passed
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self.coalesced = 0
+        self.latest = {}
+
+    def run(self):
+        resume_jobs()
+        for doc in get_new_job_docs():
+            self.waiting += 1
+            key = coalesce_key(doc)
+            if key is not None:
+                self.latest[key] = doc['_id']
+        super().run()
+
+    def enqueue(self, client_id, message):
+        try:
+            doc = decode_job(message)
+        except Exception as e:
+            logging.error('Dropped bad job message (%s)', str(e))
+            return
+        doc['state'] = JobStatus.new.value
+
+        try:
+            doc = save_job_doc(doc)
+        except jsondb.Conflict:
+            logging.warning('Job %s is already queued', doc['_id'])
+            return
+
+        # The old job is only superseded once the new one is safely stored
+        key = coalesce_key(doc)
+        previous = self.latest.get(key) if key is not None else None
+        priority = doc['priority']
+        superseded = previous is not None and previous != doc['_id'] and supersede_job(previous, doc)
+        if superseded and doc['priority'] != priority:
+            try:
+                doc = save_job_doc(doc)
+            except jsondb.Conflict:
+                logging.warning('Job %s changed, keeping its priority', doc['_id'])
+
+        if key is not None:
+            self.latest[key] = doc['_id']
+        with self.lock:
+            self.waiting += 1
+            if superseded:
+                self.waiting -= 1
+                self.coalesced += 1
+
+    def dequeue(self):
+        if self.waiting == 0:
+            return None
+        job = take_next_job()
+        if job is None:
+            return None
+        key = coalesce_key(job.to_dict())
+        if key is not None and self.latest.get(key) == job.id:
+            del self.latest[key]
+        with self.lock:
+            self.waiting -= 1
+        return b'', job.id.encode('ascii')
+
+    def count_pending(self):
+        return self.waiting
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats['coalesced'] = self.coalesced
+        return stats
 
 
 class Dispatcher(QueueWorker):
-    def work(self, message):
-        job = Job.FromJSON(message)
-        job.status = JobStatus.running
+    """
+    Run the steps of a job, each as soon as the steps it needs are done.
+    Steps that do not need each other run at the same time.
+    """
 
-        while job.status == JobStatus.running:
-            step = job.get_current_step()
+    step_threads = 4
 
-            Handler = get_job_handler_for_method(step.method)
+    def __init__(self, context):
+        super().__init__(context)
+        self.pool = ThreadPoolExecutor(max_workers=self.step_threads)
 
-            if Handler is None:
-                logging.error('Method %s is not supported', str(step.method))
-                return
-
-            Handler().run(job)
-            job.get_on_with_it()
+    def work(self, message):
+        job = get_job_by_id(message.decode('ascii'))
+        job.status = JobStatus.running
+        running = {}
+        retry_later = None
+
+        try:
+            while True:
+                if retry_later is None and job.status == JobStatus.running:
+                    for step in job.get_ready_steps():
+                        step.status = StepStatus.running
+                        running[self.pool.submit(run_step, job, step)] = step
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    error = future.exception()
+                    if isinstance(error, RetryLater):
+                        step.status = StepStatus.new
+                        retry_later = (step, error)
+                    elif error is not None:
+                        logging.error('Step %s of job %s failed', step.method, job.id, exc_info=error)
+                        step.status = StepStatus.failed
+                    elif step.status != StepStatus.done:
+                        step.status = StepStatus.failed
+
+                job.update_status()
+                save_job(job)
+
+            if retry_later is not None and job.status != JobStatus.failed:
+                defer_job(job, *retry_later)
+        finally:
+            # Sync whatever is left once there is nothing more to do for now
+            sync_pending(force=App.queue is None or App.queue.count_pending() == 0)
+            if job.status == JobStatus.running:
+                job.status = JobStatus.failed
+                save_job(job)
+            if job.status == JobStatus.done:
+                count(job.import_id, jobs_done=1)
+            elif job.status == JobStatus.failed:
+                count(job.import_id, failed=1)
+
+
+_running = threading.local()
+
+
+def run_step(job, step):
+    Handler = get_job_handler_for_method(step.method)
+
+    if Handler is None:
+        logging.error('Method %s is not supported', str(step.method))
+        return
+
+    _running.step = step
+    set_current_method(step.method)
+    try:
+        Handler().run(job)
+    finally:
+        set_current_method(None)
+        _running.step = None
 
 
 # DESCRIPTOR
@@ -65,6 +251,7 @@ class StepStatus(EnumProperty):
     done = "done"
     running = "running"
     failed = "failed"
+    skipped = "skipped"
 
 
 class Step(PropertySet):
@@ -73,6 +260,8 @@ class Step(PropertySet):
     options = Property(wrap=True)
     result = Property(wrap=True)
     status = Property(enum=StepStatus, default=StepStatus.new)
+    attempts = Property(int, default=0)
+    needs = Property(list)  # methods of the steps this one needs, None for the step before
 
 
 class JobStatus(EnumProperty):
@@ -80,31 +269,269 @@ class JobStatus(EnumProperty):
     done = "done"
     running = "running"
     failed = "failed"
+    superseded = "superseded"
+
+
+PRIORITY_INTERACTIVE = 10
+PRIORITY_NORMAL = 100
+MAX_RETRY_DELAY = 3600.0
+TAKE_PAGE_SIZE = 100  # new jobs read at a time when looking for a released one
 
 
 class Job(PropertySet):
+    id = Property(name='_id')
+    revision = Property(int, name='_rev')
     current_step = Property(type=int, default=0)
     steps = Property(type=Step, is_list=True)
-    status = Property(enum=JobStatus, default=JobStatus.new)
+    status = Property(enum=JobStatus, default=JobStatus.new, name='state')
+    priority = Property(int, default=PRIORITY_NORMAL)
+    release = Property(float, default=0.0)
+    updated = Property(float)
+    import_id = Property()
+
+    def to_bytes(self):
+        return encode_job(self)
 
     def get_current_step(self) -> Step:
+        step = getattr(_running, 'step', None)
+        if step is not None and any(s is step for s in self.steps):
+            return step
         return self.steps[self.current_step]
-    
-    def get_on_with_it(self):
-        step = self.get_current_step()
-        if step.status != StepStatus.done:
+
+    def get_needed_steps(self, index):
+        step = self.steps[index]
+        if step.needs is None:
+            return self.steps[index - 1:index] if index > 0 else []
+        return [s for s in self.steps if s.method in step.needs]
+
+    def get_ready_steps(self):
+        return [
+            step for index, step in enumerate(self.steps)
+            if step.status == StepStatus.new and all(
+                needed.status in (StepStatus.done, StepStatus.skipped)
+                for needed in self.get_needed_steps(index)
+            )
+        ]
+
+    def update_status(self):
+        """Work out the job status and current step from the steps."""
+        finished = (StepStatus.done, StepStatus.skipped)
+        self.current_step = next(
+            (i for i, step in enumerate(self.steps) if step.status not in finished),
+            len(self.steps) - 1,
+        )
+        if any(step.status == StepStatus.failed for step in self.steps):
             self.status = JobStatus.failed
-            step.status = StepStatus.failed
-        else:
-            self.current_step += 1
-            if self.current_step < len(self.steps):
-                self.status = JobStatus.running
-            else:
-                self.status = JobStatus.done
-    
+        elif all(step.status in finished for step in self.steps):
+            self.status = JobStatus.done
+
     def get_step(self, method) -> Step:
         return next(filter(lambda x: x.method == method, self.steps), None)
 
+    def skip_remaining(self, keep=()):
+        for step in self.steps:
+            if step.status == StepStatus.new and step.method not in keep:
+                step.status = StepStatus.skipped
+
+
+# WIRE FORMAT
+#############
+#
+# Jobs are sent to the queue as a fixed header followed by the job dict as
+# compact UTF-8 JSON. The broker stores the dict as it is, so step options
+# are only wrapped in their classes when a worker reads the job back.
+
+WIRE_HEADER = struct.Struct('>4sBI')  # magic, version, payload length
+WIRE_MAGIC = b'IMJ\x00'
+WIRE_VERSION = 2
+
+
+def encode_job(job) -> bytes:
+    payload = json.dumps(job.to_dict(), separators=(',', ':')).encode('utf8')
+    return WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, len(payload)) + payload
+
+
+def decode_job(message) -> dict:
+    """Read a job dict from a message. Raises ValueError if it is not one."""
+    if message[:len(WIRE_MAGIC)] != WIRE_MAGIC:
+        payload = message
+    else:
+        if len(message) < WIRE_HEADER.size:
+            raise ValueError('Truncated job message')
+        _, version, length = WIRE_HEADER.unpack_from(message)
+        if version != WIRE_VERSION:
+            raise ValueError('Unknown job format version %d' % version)
+        if len(message) != WIRE_HEADER.size + length:
+            raise ValueError('Truncated job message')
+        payload = message[WIRE_HEADER.size:]
+    doc = json.loads(payload.decode('utf8'))
+    if not isinstance(doc, dict):
+        raise ValueError('Job message is not an object')
+    return doc
+
+
+# API
+#####
+
+
+def get_job_by_id(id) -> Job:
+    try:
+        return Job.FromDict(current_system().db['job'][id])
+    except KeyError:
+        raise bottle.HTTPError(404)
+
+
+def save_job(job) -> Job:
+    doc = save_job_doc(job.to_dict())
+    job.id = doc['_id']
+    job.revision = doc['_rev']
+    job.updated = doc['updated']
+    return job
+
+
+def save_job_doc(doc):
+    if doc.get('_id') is None:
+        doc['_id'] = uuid.uuid4().hex
+    doc.setdefault('priority', PRIORITY_NORMAL)
+    doc.setdefault('release', 0.0)
+    doc['updated'] = time.time()
+    return current_system().db['job'].save(doc)
+
+
+def create_job(job) -> Job:
+    """Hand the job to the queue. Lower priority numbers run first."""
+    if job.id is None:
+        job.id = uuid.uuid4().hex
+    with QueueClient('ipc://job_queue') as q:
+        q.send(job)
+    return job
+
+
+def defer_job(job, step, retry_later):
+    """Put the job back in the queue, to run the step again later."""
+    step.attempts += 1
+    if step.attempts > retry_later.max_retries:
+        logging.error('Gave up on step %s of job %s (%s)', step.method, job.id, str(retry_later))
+        step.status = StepStatus.failed
+        job.status = JobStatus.failed
+        save_job(job)
+        return
+
+    delay = min(retry_later.delay * 2 ** (step.attempts - 1), MAX_RETRY_DELAY)
+    logging.info('Retrying step %s of job %s in %.1f s (%s)', step.method, job.id, delay, str(retry_later))
+    job.release = time.time() + delay
+    job.status = JobStatus.new
+    create_job(job)
+
+
+def take_next_job() -> Job:
+    """Mark the first released new job as running and return it, if any."""
+    now = time.time()
+    db = current_system().db['job']
+    skip = 0
+    while True:
+        rows = list(db.view(
+            'by_state',
+            startkey=(JobStatus.new.value, ),
+            endkey=(JobStatus.new.value, any),
+            include_docs=True,
+            skip=skip,
+            limit=TAKE_PAGE_SIZE,
+        ))
+        for row in rows:
+            job = Job.FromDict(row['doc'])
+            if job.release > now:
+                continue
+            job.status = JobStatus.running
+            try:
+                return save_job(job)
+            except jsondb.Conflict:
+                continue
+        if len(rows) < TAKE_PAGE_SIZE:
+            return None
+        skip += len(rows)
+
+
+def resume_jobs():
+    """
+    Put jobs that were running when the server stopped back in the queue.
+    They continue from the first step that was not done.
+    """
+    db = current_system().db['job']
+    running = list(db.view(
+        'by_state',
+        startkey=(JobStatus.running.value, ),
+        endkey=(JobStatus.running.value, any),
+        include_docs=True,
+    ))
+    for row in running:
+        job = Job.FromDict(row['doc'])
+        logging.info('Resuming job %s at step %d', job.id, job.current_step)
+        for step in job.steps:
+            if step.status == StepStatus.running:
+                step.status = StepStatus.new
+        job.status = JobStatus.new
+        save_job(job)
+
+
+def get_new_job_docs():
+    for row in current_system().db['job'].view(
+            'by_state',
+            startkey=(JobStatus.new.value, ),
+            endkey=(JobStatus.new.value, any),
+            include_docs=True):
+        yield row['doc']
+
+
+def coalesce_key(doc):
+    """
+    Jobs with the same steps, options included, do the same work, so only
+    the latest of them needs to run. Jobs that are not about an entry are
+    never coalesced. Step status, results and attempts are left out, they
+    change as the job runs, and so are unset options, which may or may not
+    be in the doc depending on where it came from.
+    """
+    steps = doc.get('steps') or []
+    options = [
+        {key: value for key, value in (step.get('options') or {}).items() if value is not None}
+        for step in steps
+    ]
+    if not any(o.get('entry_id') for o in options):
+        return None
+    return json.dumps([
+        (step.get('method'), o, step.get('needs'))
+        for step, o in zip(steps, options)
+    ], sort_keys=True)
+
+
+def supersede_job(id, doc):
+    """
+    Mark the queued job with the given id as superseded by the job doc,
+    unless it has started. The doc keeps the more urgent priority of the
+    two. Returns True if the job was superseded.
+    """
+    db = current_system().db['job']
+    try:
+        old = db[id]
+    except KeyError:
+        return False
+
+    if old.get('state') != JobStatus.new.value:
+        return False
+    if any(step.get('status', StepStatus.new.value) != StepStatus.new.value for step in old.get('steps') or []):
+        return False
+
+    old['state'] = JobStatus.superseded.value
+    try:
+        save_job_doc(old)
+    except jsondb.Conflict:
+        return False
+
+    logging.info('Job %s supersedes job %s', doc.get('_id'), id)
+    doc['priority'] = min(doc.get('priority', PRIORITY_NORMAL), old.get('priority', PRIORITY_NORMAL))
+    count(old.get('import_id'), jobs_done=1)
+    return True
+
 
 # JOB HANDLING
 ##############
@@ -138,8 +565,8 @@ class JobHandler(object):
         raise NotImplementedError
 
     @classmethod
-    def AsStep(cls, **kwargs):
-        return Step(method=cls.method, options=cls.Options(**kwargs))
+    def AsStep(cls, needs=None, **kwargs):
+        return Step(method=cls.method, options=cls.Options(**kwargs), needs=needs)
 
 
 class DummyOptions(PropertySet):
@@ -151,8 +578,10 @@ class DummyJobHandler(JobHandler):
     Options = DummyOptions
 
     def run(self, job):
-        options = job.options
-        time.sleep(options.time)
+        step = job.get_current_step()
+        if step.attempts == 0 and step.options.time > 0:
+            raise RetryLater('Pretending to work', delay=step.options.time, max_retries=1)
+        step.status = StepStatus.done
 
 
 register_job_handler(DummyJobHandler)
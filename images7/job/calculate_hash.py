@@ -10,6 +10,7 @@ from jsonobject import PropertySet, Property, register_schema
 
 from images7.job import JobHandler, Job, StepStatus, register_job_handler
 from images7.localfile import calculate_hash
+from images7.multi import offload, device_slot
 
 
 class CalculateHashOptions(PropertySet):
@@ -36,12 +37,15 @@ class CalculateHash(JobHandler):
         step = job.get_current_step()
         
         if step.options.path is not None:
-            path = step.options.path
+            with device_slot(step.options.path):
+                ref = offload(calculate_hash, step.options.path)
         else:
             cut = job.get_step('to_cut')
-            path = cut.result.path
-
-        ref = calculate_hash(path)
+            if cut.result.calculated_hash is not None:
+                ref = cut.result.calculated_hash
+            else:
+                with device_slot(cut.result.path):
+                    ref = offload(calculate_hash, cut.result.path)
 
         step.result = CalculateHashResult(calculated_hash=ref)
         step.status = StepStatus.done
@@ -10,8 +10,7 @@ from jsonobject import PropertySet, Property, register_schema
 from images7.system import current_system
 from images7.config import resolve_path
 from images7.job import JobHandler, Job, StepStatus, register_job_handler
-from images7.retry import retry
-from images7.entry import get_entry_by_id, update_entry_by_id, FilePurpose, FileReference
+from images7.entry import get_entry_by_id, append_file_references, FilePurpose, FileReference
 from images7.files import get_file_by_url, create_file, File, FileStatus
 from images7.localfile import FileCopy
 from images7.job.transcode import get_transcoder
@@ -58,14 +57,15 @@ class CreateProxy(JobHandler):
             return
 
         targets = [
-            transcoder.Options(entry=entry, cut_source=source_path, purpose=FilePurpose.proxy),
-            transcoder.Options(entry=entry, cut_source=source_path, purpose=FilePurpose.thumb),
-            transcoder.Options(entry=entry, cut_source=source_path, purpose=FilePurpose.check),
+            transcoder.Options(entry_id=entry.id, cut_source=source_path, purpose=FilePurpose.proxy),
+            transcoder.Options(entry_id=entry.id, cut_source=source_path, purpose=FilePurpose.thumb),
+            transcoder.Options(entry_id=entry.id, cut_source=source_path, purpose=FilePurpose.check),
         ]
 
         filerefs = []
-        for target in targets:
-            f = transcoder.run(target)
+        for target, f in zip(targets, transcoder.run_many(targets)):
+            if f is None:
+                continue
             filerefs.append(FileReference(
                 purpose=target.purpose,
                 version=source_ref.version,
@@ -75,22 +75,7 @@ class CreateProxy(JobHandler):
         
         logging.info(filerefs)
 
-        @retry()
-        def push():
-            entry = get_entry_by_id(step.options.entry_id)
-
-            for file_ref in filerefs:
-                new_file_ref = FileReference(
-                    purpose=file_ref.purpose,
-                    version=file_ref.version,
-                    reference=file_ref.reference,
-                    mime_type=file_ref.mime_type,
-                )
-                entry.files.append(new_file_ref)
-
-            update_entry_by_id(entry.id, entry)
-
-        push()
+        append_file_references(step.options.entry_id, filerefs)
 
         step.result = CreateProxyResult()
         step.status = StepStatus.done
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import logging
+
+from jsonobject import PropertySet, Property, register_schema
+
+from images7.job import JobHandler, Job, StepStatus, register_job_handler
+from images7.entry import get_entries_by_reference, remove_file_reference, delete_entry_by_id
+from images7.files import get_file_by_url, get_files_by_reference, get_files_by_fingerprint, update_file, FileStatus
+from images7.localfile import calculate_hash
+from images7.multi import offload, device_slot
+
+
+class DedupOptions(PropertySet):
+    entry_id = Property()
+    source_url = Property()
+
+
+register_schema(DedupOptions)
+
+
+class DedupResult(PropertySet):
+    duplicate_of = Property()
+
+
+register_schema(DedupResult)
+
+
+class Dedup(JobHandler):
+    """
+    Look up the calculated hash among the files already in main storage.
+    If it is there, point the source file at it, drop it from the new
+    entry and skip the copy and transcoding steps that would follow.
+    """
+    method = 'dedup'
+    Options = DedupOptions
+
+    def run(self, job: Job):
+        logging.debug(job.to_json())
+
+        step = job.get_current_step()
+        reference = job.get_step('calculate_hash').result.calculated_hash
+        step.result = DedupResult()
+
+        managed = [f for f in get_files_by_reference(reference) if f.status == FileStatus.managed]
+        existing = next((
+            entry for entry in get_entries_by_reference(reference).entries
+            if entry.id != step.options.entry_id
+        ), None)
+
+        if not managed or existing is None:
+            step.status = StepStatus.done
+            return
+
+        logging.info('%s is a duplicate of entry %s', step.options.source_url, existing.id)
+
+        source = get_file_by_url(step.options.source_url)
+        old_reference = source.reference
+        source.reference = reference
+        update_file(source)
+
+        entry = remove_file_reference(step.options.entry_id, old_reference)
+        if len(entry.files) == 0:
+            delete_entry_by_id(entry.id)
+
+        job.skip_remaining(keep=('clean_cut', ))
+
+        step.result.duplicate_of = existing.id
+        step.status = StepStatus.done
+
+
+register_job_handler(Dedup)
+
+
+def find_duplicate(path, fingerprint):
+    """
+    Return the reference of a managed file with the same content as the
+    file at path, or None. The file is only hashed in full if there are
+    managed files with the same fingerprint.
+    """
+    candidates = {
+        f.reference for f in get_files_by_fingerprint(fingerprint)
+        if f.status == FileStatus.managed
+    }
+    if not candidates:
+        return None
+
+    with device_slot(path):
+        reference = offload(calculate_hash, path)
+    if reference not in candidates:
+        return None
+    return reference
@@ -5,12 +5,12 @@ import logging
 import uuid
 import datetime
 
-from jsonobject import PropertySet, Property, register_schema
+from jsonobject import PropertySet, Property, register_schema, get_schema
 
 from images7.job import JobHandler, Job, StepStatus, register_job_handler
 from images7.analyse import get_analyser
-from images7.retry import retry
-from images7.entry import get_entry_by_id, update_entry_by_id
+from images7.entry import merge_entry_metadata
+from images7.multi import offload
 
 
 class ReadMetadataOptions(PropertySet):
@@ -38,35 +38,72 @@ class ReadMetadata(JobHandler):
 
         step = job.get_current_step()
 
+        metadata = None
         if step.options.path is not None:
             path = step.options.path
         else:
             cut = job.get_step('to_cut')
             path = cut.result.path
+            metadata = cut.result.metadata
 
-        analyse = get_analyser(step.options.mime_type)
+        if metadata is None:
+            analyse = get_analyser(step.options.mime_type)
 
-        if analyse is None:
-            logging.info("Found no metadata analyser for %s", step.options.mime_type)
-            step.status = StepStatus.done
-            return
+            if analyse is None:
+                logging.info("Found no metadata analyser for %s", step.options.mime_type)
+                step.status = StepStatus.done
+                return
 
-        metadata = analyse(path)
+            metadata = offload(analyse_as_dict, analyse, path)
+            if metadata is not None:
+                schema, metadata = metadata
+                metadata = get_schema(schema).FromDict(metadata)
 
         if metadata is not None and step.options.entry_id is not None:
-            @retry()
-            def update():
-                entry = get_entry_by_id(step.options.entry_id)
-                if entry.metadata is None:
-                    entry.metadata = metadata
-                else:
-                    entry.metadata.merge(metadata)
-                update_entry_by_id(entry.id, entry)
-            
-            update()
+            merge_entry_metadata(step.options.entry_id, metadata)
 
         step.result = ReadMetadataResult(metadata=metadata)
         step.status = StepStatus.done
 
 
 register_job_handler(ReadMetadata)
+
+
+class MergeMetadataOptions(PropertySet):
+    entry_id = Property()
+
+
+register_schema(MergeMetadataOptions)
+
+
+class MergeMetadata(JobHandler):
+    """
+    Merge the metadata found by the read_metadata step into the entry. Kept
+    apart so that reading can start before it is known whether the entry
+    will be kept.
+    """
+    method = 'merge_metadata'
+    Options = MergeMetadataOptions
+
+    def run(self, job: Job):
+        logging.debug(job.to_json())
+
+        step = job.get_current_step()
+        read = job.get_step('read_metadata')
+        metadata = read.result.metadata if read.result is not None else None
+
+        if metadata is not None:
+            merge_entry_metadata(step.options.entry_id, metadata)
+
+        step.status = StepStatus.done
+
+
+register_job_handler(MergeMetadata)
+
+
+def analyse_as_dict(analyse, path):
+    # Plain data travels better between processes than property sets
+    metadata = analyse(path)
+    if metadata is None:
+        return None
+    return type(metadata).__name__, metadata.to_dict()
@@ -6,14 +6,17 @@ from jsondb import Conflict
 from images7.job import Job, JobHandler, Step, StepStatus, register_job_handler
 from images7.job.to_cut import ToCut
 from images7.job.calculate_hash import CalculateHash
-from images7.job.read_metadata import ReadMetadata
+from images7.job.dedup import Dedup, find_duplicate
+from images7.job.read_metadata import ReadMetadata, MergeMetadata
 from images7.job.to_main import ToMain
 from images7.job.create_proxy import CreateProxy
 from images7.job.clean_cut import CleanCut
 from images7.system import current_system
-from images7.files import File, FileStatus, get_file_by_url, create_file
-from images7.entry import Entry, FileReference, FilePurpose, EntryType, DefaultEntryMetadata, get_entries_by_reference, create_entry, update_entry_by_id
-from images7.multi import QueueClient
+from images7.files import File, FileStatus, get_files_by_urls, create_file, create_files
+from images7.localfile import calculate_fingerprint
+from images7.entry import Entry, FileReference, FilePurpose, EntryType, DefaultEntryMetadata, get_entries_by_reference, create_entries
+from images7.multi import QueueClient, device_slot
+from images7.progress import count
 
 
 class RegisterPart(PropertySet):
@@ -30,52 +33,174 @@ class RegisterPart(PropertySet):
         return source.get_part_url(self)
 
 
+class RegisterStem(PropertySet):
+    parts = Property(type=RegisterPart, is_list=True)
+
+
 class RegisterImportOptions(PropertySet):
     parts = Property(type=RegisterPart, is_list=True)
+    stems = Property(type=RegisterStem, is_list=True)
 
 
 register_schema(RegisterImportOptions)
 
 
 class Register(JobHandler):
+    """
+    Register the files of one or many stems (files with the same name but
+    different extensions), create an entry for each new stem and queue an
+    import job for each new file.
+    """
     Options = RegisterImportOptions
     method = 'register'
 
     def run(self, job):
         logging.info('Starting register import.')
         assert job is not None, "Job can't be None"
-        logging.info('Job\n%s', job.to_json())
+        logging.debug('Job\n%s', job.to_json())
         self.step = job.get_current_step()
         self.system = current_system()
         self.options = self.step.options
 
-        self.register_parts()
+        self.import_id = job.import_id
+        stems = self.options.stems or [RegisterStem(parts=self.options.parts)]
+        self.register_stems(stems)
 
         self.step.status = StepStatus.done
         return self.step
 
-    def register_parts(self):
+    def register_stems(self, stems):
+        urls = [part.get_url(self.system) for stem in stems for part in stem.parts]
+        existing = get_files_by_urls(urls)
+
+        files = []
+        registered = []
+        for stem in stems:
+            new_files, entry, sources = self.register_parts(stem.parts, existing)
+            files.extend(new_files)
+            if entry is not None:
+                registered.append((entry, sources, new_files))
+
+        try:
+            create_files(files)
+        except Conflict:
+            logging.warning('Some files were registered elsewhere, registering one by one')
+            failed = self.create_files_one_by_one(files)
+            registered = [
+                (entry, sources, new_files) for entry, sources, new_files in registered
+                if not any(f.url in failed for f in new_files)
+            ]
+
+        entries = create_entries([entry for entry, _, _ in registered])
+
+        jobs = []
+        for entry, (_, sources, _) in zip(entries, registered):
+            for f, root_path, proxy in sources:
+                steps = [
+                    ToCut.AsStep(
+                        source_root_path=root_path,
+                        source_url=f.url,
+                    ),
+                    CalculateHash.AsStep(
+                        needs=['to_cut'],
+                    ),
+                    # Reading the metadata goes on while hashing, the entry
+                    # is only written to once dedup has kept it
+                    ReadMetadata.AsStep(
+                        needs=['to_cut'],
+                        mime_type=f.mime_type,
+                    ),
+                    Dedup.AsStep(
+                        needs=['calculate_hash'],
+                        entry_id=entry.id,
+                        source_url=f.url,
+                    ),
+                    MergeMetadata.AsStep(
+                        needs=['read_metadata', 'dedup'],
+                        entry_id=entry.id,
+                    ),
+                    ToMain.AsStep(
+                        needs=['dedup', 'read_metadata'],
+                        entry_id=entry.id,
+                        source_url=f.url,
+                    ),
+                ]
+                if proxy:
+                    steps.append(CreateProxy.AsStep(
+                        needs=['merge_metadata'],
+                        entry_id=entry.id,
+                        source_url=f.url,
+                    ))
+                steps.append(CleanCut.AsStep(
+                    needs=['to_main', 'create_proxy', 'read_metadata', 'merge_metadata'],
+                ))
+                jobs.append(Job(
+                    import_id=self.import_id,
+                    steps=steps,
+                ))
+
+        if jobs:
+            with QueueClient('ipc://job_queue') as q:
+                for job in jobs:
+                    q.send(job)
+            count(self.import_id, jobs_queued=len(jobs))
+
+        logging.info('Registered %d of %d stems.', len(entries), len(stems))
+
+    def create_files_one_by_one(self, files):
+        """
+        Save the files one at a time and return the urls of the ones that
+        someone else registered. A file that is already saved exactly as
+        given counts as saved, as a batch save may have got that far before
+        failing.
+        """
+        failed = set()
+        for f in files:
+            try:
+                create_file(f)
+            except Conflict:
+                stored = get_files_by_urls([f.url]).get(f.url)
+                if stored is not None and _same_file(stored, f):
+                    continue
+                logging.warning('File %s is already registered', f.url)
+                failed.add(f.url)
+        return failed
+
+    def register_parts(self, parts, existing):
+        """
+        Work out the files of one stem. Returns the File docs to create, the
+        Entry to create (None if the stem has one already) and the files
+        that need importing, with their root paths and whether to create
+        proxies from them.
+        """
         raw = None
         original = None
         derivative = None
         entry = None
         source = None
         root_path = None
+        new_files = []
 
-        for part in self.options.parts:
+        for part in parts:
             url = part.get_url(self.system)
             root_path = root_path or part.root_path
-            f = File(url=url, reference=url, status=FileStatus.new, mime_type=part.mime_type)
 
-            try:
-                f = create_file(f)
-            except Conflict:
-                f = get_file_by_url(url)
+            f = existing.get(url)
+            if f is not None:
                 if f.reference is not None:
                     entry = next(iter(get_entries_by_reference(f.reference).entries), None)
-
-            if f is None:
-                logging.error('Bad file: %s', f.to_json())
+            else:
+                path = os.path.join(part.root_path, part.path)
+                with device_slot(path):
+                    fingerprint = calculate_fingerprint(path)
+                f = File(url=url, reference=url, status=FileStatus.new, mime_type=part.mime_type, fingerprint=fingerprint)
+                new_files.append(f)
+
+                reference = find_duplicate(path, fingerprint)
+                if reference is not None and get_entries_by_reference(reference).count > 0:
+                    logging.info('%s is already in main storage', url)
+                    f.reference = reference
+                    continue
 
             if part.is_raw:
                 raw = f
@@ -88,59 +213,39 @@ class Register(JobHandler):
 
         primary = raw or original or derivative
 
-        if primary is None:
-            logging.error('No valid file!\n%s', self.step.to_json())
-            return
-
-        if entry is None:
-            entry = Entry(
-                type=EntryType.image,
-                metadata=DefaultEntryMetadata(
-                    original_filename=os.path.basename(primary.url),
-                    source=source,
-                ),
-            )
-            entry = create_entry(entry)
-            jobs = []
-            for f, p in ((raw, FilePurpose.raw), (original, FilePurpose.original), (derivative, FilePurpose.derivative)):
-                if f is None:
-                    continue
+        if entry is not None or primary is None:
+            return new_files, None, []
+
+        entry = Entry(
+            type=EntryType.image,
+            metadata=DefaultEntryMetadata(
+                original_filename=os.path.basename(primary.url),
+                source=source,
+            ),
+        )
+        # Proxies come from one file only, RAW previews only as a last resort
+        proxy_source = original or derivative or raw
+        sources = []
+        for f, p in ((raw, FilePurpose.raw), (original, FilePurpose.original), (derivative, FilePurpose.derivative)):
+            if f is None:
+                continue
 
-                entry.files.append(FileReference(
-                    reference=f.reference,
-                    purpose=p,
-                    version=0,
-                    mime_type=f.mime_type,
-                ))
+            entry.files.append(FileReference(
+                reference=f.reference,
+                purpose=p,
+                version=0,
+                mime_type=f.mime_type,
+            ))
+            sources.append((f, root_path, f is proxy_source))
 
-                jobs.append(Job(
-                    steps=[
-                        ToCut.AsStep(
-                            source_root_path=root_path,
-                            source_url=f.url,
-                        ),
-                        CalculateHash.AsStep(),
-                        ReadMetadata.AsStep(
-                            entry_id=entry.id,
-                            mime_type=f.mime_type,
-                        ),
-                        ToMain.AsStep(
-                            entry_id=entry.id,
-                            source_url=f.url,
-                        ),
-                        CreateProxy.AsStep(
-                            entry_id=entry.id,
-                            source_url=f.url,
-                        ),
-                        CleanCut.AsStep(),
-                    ]
-                ))
+        return new_files, entry, sources
 
-            update_entry_by_id(entry.id, entry)
 
-            with QueueClient('ipc://job_queue') as q:
-                for job in jobs:
-                    q.send(job)
+def _same_file(a, b):
+    a, b = a.to_dict(), b.to_dict()
+    a.pop('_rev', None)
+    b.pop('_rev', None)
+    return a == b
 
 
 register_job_handler(Register)
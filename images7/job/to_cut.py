@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import logging
 import uuid
@@ -10,7 +11,10 @@ from images7.system import current_system
 from images7.config import resolve_path
 from images7.job import JobHandler, Job, register_job_handler, StepStatus
 from images7.files import get_file_by_url
-from images7.localfile import FileCopy
+from images7.localfile import TeeCopy
+from images7.analyse import get_header_analyser
+from images7.progress import count
+from images7.multi import device_slot
 
 
 class ToCutOptions(PropertySet):
@@ -23,6 +27,10 @@ register_schema(ToCutOptions)
 
 class ToCutResult(PropertySet):
     path = Property()
+    size = Property(int)
+    calculated_hash = Property()
+    fingerprint = Property()
+    metadata = Property(wrap=True)
 
 
 register_schema(ToCutResult)
@@ -52,15 +60,29 @@ class ToCut(JobHandler):
         else:
             raise Exception("Only support card here")
 
-        filecopy = FileCopy(
+        tee = TeeCopy(
             source=source_path,
             destination=cut_path,
-            link=False,
-            remove_source=False,
         )
-        filecopy.run()
-
-        step.result = ToCutResult(path=cut_path)
+        with device_slot(source_path):
+            tee.run()
+        count(job.import_id, bytes_copied=tee.size)
+
+        metadata = None
+        analyse = get_header_analyser(source.mime_type)
+        if analyse is not None:
+            try:
+                metadata = analyse(io.BytesIO(tee.header))
+            except Exception as e:
+                logging.debug("Could not analyse header of %s (%s)", source_path, str(e))
+
+        step.result = ToCutResult(
+            path=cut_path,
+            size=tee.size,
+            calculated_hash=tee.calculated_hash,
+            fingerprint=tee.fingerprint,
+            metadata=metadata,
+        )
         step.status = StepStatus.done
 
 
@@ -10,8 +10,7 @@ from jsonobject import PropertySet, Property, register_schema
 from images7.system import current_system
 from images7.config import resolve_path
 from images7.job import JobHandler, Job, StepStatus, register_job_handler
-from images7.retry import retry
-from images7.entry import get_entry_by_id, update_entry_by_id, FilePurpose, FileReference
+from images7.entry import get_entry_by_id, append_file_references, FilePurpose, FileReference
 from images7.files import get_file_by_url, create_file, File, FileStatus
 from images7.localfile import FileCopy
 
@@ -44,10 +43,10 @@ class ToMain(JobHandler):
         entry = get_entry_by_id(step.options.entry_id)
         source = get_file_by_url(step.options.source_url)
 
+        cut = job.get_step('to_cut')
         if step.options.path is not None:
             source_path = step.options.path
         else:
-            cut = job.get_step('to_cut')
             source_path = cut.result.path
 
         assert source_path, "Missing source path (forgot to_cut step?)"
@@ -92,27 +91,21 @@ class ToMain(JobHandler):
         )
         filecopy.run()
 
-        @retry()
-        def push():
-            entry = get_entry_by_id(step.options.entry_id)
-            new_file_ref = FileReference(
-                purpose=file_ref.purpose,
-                version=file_ref.version,
-                reference=reference,
-                mime_type=file_ref.mime_type,
-            )
-            new_file = File(
-                reference=reference,
-                url=system.main_storage.get_file_url(main_path),
-                mime_type=source.mime_type,
-                status=FileStatus.managed,
-            )
-            create_file(new_file)
-
-            entry.files.append(new_file_ref)
-            update_entry_by_id(entry.id, entry)
-
-        push()
+        new_file = File(
+            reference=reference,
+            url=system.main_storage.get_file_url(main_path),
+            mime_type=source.mime_type,
+            status=FileStatus.managed,
+            fingerprint=cut.result.fingerprint if cut is not None else None,
+        )
+        create_file(new_file)
+
+        append_file_references(step.options.entry_id, [FileReference(
+            purpose=file_ref.purpose,
+            version=file_ref.version,
+            reference=reference,
+            mime_type=file_ref.mime_type,
+        )])
 
         step.result = ToMainResult()
         step.status = StepStatus.done
@@ -29,4 +29,7 @@ class Transcoder:
     Options = DefaultTranscodeOptions
 
     def run(self, options):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    def run_many(self, options_list):
+        return [self.run(options) for options in options_list]
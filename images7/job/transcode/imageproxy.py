@@ -7,16 +7,16 @@ from images7.config import resolve_path
 from images7.system import current_system
 from images7.files import File, FileStatus, create_file
 from images7.entry import (
-    Entry,
     FilePurpose,
+    get_entry_by_id,
 )
 from images7.job.transcode import Transcoder, DefaultTranscodeOptions, register_transcoder
 from images7.localfile import FileCopy, calculate_hash
-from images7.retry import retry
+from images7.multi import offload
 
 
 class ImageProxyOptions(DefaultTranscodeOptions):
-    entry = Property(type=Entry)
+    entry_id = Property()
 
 
 register_schema(ImageProxyOptions)
@@ -28,10 +28,10 @@ class ImageTranscoder(Transcoder):
     def run(self, options: ImageProxyOptions):
         logging.info('Starting image transaction.')
         assert options is not None, "Options can't be None"
-        logging.info('Options\n%s', options.to_json())
+        logging.debug('Options\n%s', options.to_json())
 
-        entry = options.entry
-        logging.info('Entry\n%s', entry.to_json())
+        entry = get_entry_by_id(options.entry_id)
+        logging.debug('Entry\n%s', entry.to_json())
         self.system = current_system()
 
         self.full_original_file_path = options.cut_source
@@ -75,16 +75,76 @@ class ImageTranscoder(Transcoder):
             logging.info("Nothing to do.")
             return
 
-        @retry()
-        def create():
-            create_file(product)
-        
-        create()
+        create_file(product)
 
         logging.info("Generated:\n" + product.to_json())
 
         return product
 
+    def run_many(self, options_list):
+        """
+        Decode the source once and create all requested purposes from it.
+        All options must share the same entry and cut source. Returns one
+        File (or None) per options.
+        """
+        logging.info('Starting multi image transaction.')
+        entry, targets = self.prepare(options_list)
+
+        offload(
+            _create_all,
+            self.full_original_file_path,
+            [target for target in targets if target is not None],
+            angle=getattr(entry.metadata, 'angle', 0),
+            mirror=getattr(entry.metadata, 'mirror', 0),
+        )
+
+        return self.store_all(entry, targets)
+
+    def prepare(self, options_list):
+        assert options_list, "Options can't be empty"
+
+        entry = get_entry_by_id(options_list[0].entry_id)
+        self.system = current_system()
+        self.full_original_file_path = options_list[0].cut_source
+        settings = self.system.config.get_job_settings('import')
+
+        sizes = {
+            FilePurpose.proxy: settings.proxy_size,
+            FilePurpose.thumb: settings.thumb_size,
+            FilePurpose.check: settings.check_size,
+        }
+
+        targets = []
+        for options in options_list:
+            if options.purpose not in sizes:
+                logging.info("Nothing to do for %s.", options.purpose)
+                targets.append(None)
+                continue
+            targets.append((
+                options.purpose.value,
+                self.full_original_file_path + '_' + options.purpose.value,
+                sizes[options.purpose],
+            ))
+
+        return entry, targets
+
+    def store_all(self, entry, targets):
+        products = []
+        for target in targets:
+            if target is None or not os.path.exists(target[1]):
+                products.append(None)
+                continue
+
+            purpose, cut_target, _ = target
+            product = self.store(cut_target, entry.type.value, purpose)
+
+            create_file(product)
+
+            logging.info("Generated:\n" + product.to_json())
+            products.append(product)
+
+        return products
+
 
     #def delete_deprecated(self):
     #    logging.debug('Deleting deprecated variants...')
@@ -115,45 +175,33 @@ class ImageTranscoder(Transcoder):
 
     def generate_rescaled(self, store, purpose, longest_edge, angle, mirror):
         cut_target = self.full_original_file_path + '_' + purpose.value
-        _convert(
+        offload(
+            _convert,
             self.full_original_file_path,
             cut_target,
             longest_edge=longest_edge,
             angle=angle,
             mirror=mirror,
         )
-        reference = calculate_hash(cut_target)
-
-        main_root = resolve_path(self.system.main_storage.root_path)
-        parts = [main_root, store, purpose.value, reference[:2], reference[2:] + '.jpg']
-        main_path = os.path.join(*parts)
-        FileCopy(
-            source=cut_target,
-            destination=main_path,
-            link=True,
-            remove_source=True,
-        ).run()
-        f = File(
-            reference=reference,
-            url=self.system.main_storage.get_file_url(main_path),
-            mime_type='image/jpeg',
-            status=FileStatus.managed,
-        )
-        return f
+        return self.store(cut_target, store, purpose.value)
 
     def create_check(self, store, angle, mirror):
         cut_target = self.full_original_file_path + '_check'
-        _create_check(
+        offload(
+            _create_check,
             self.full_original_file_path,
             cut_target,
             angle=angle,
             mirror=mirror,
             size=self.system.config.get_job_settings('import').check_size,
         )
-        reference = calculate_hash(cut_target)
+        return self.store(cut_target, store, 'check')
+
+    def store(self, cut_target, store, purpose):
+        reference = offload(calculate_hash, cut_target)
 
         main_root = resolve_path(self.system.main_storage.root_path)
-        parts = [main_root, store, 'check', reference[:2], reference[2:] + '.jpg']
+        parts = [main_root, store, purpose, reference[:2], reference[2:] + '.jpg']
         main_path = os.path.join(*parts)
         FileCopy(
             source=cut_target,
@@ -180,51 +228,121 @@ register_transcoder('image/gif', 'proxy', ImageTranscoder)
 def _create_check(path_in, path_out, size=200, angle=None, mirror=None):
     os.makedirs(os.path.dirname(path_out), exist_ok=True)
 
-    with open(path_out, 'w') as out:
+    with open(path_out, 'wb') as out:
         img = Image.open(path_in)
-        width, height = img.size
+        _crop(img, size, out, angle, mirror)
+        img.close()
+        logging.debug("Created check %s", path_out)
+        return size, size
 
-        left = int((width - size) / 2)
-        top = int((height - size) / 2)
-        right = int((width + size) / 2)
-        bottom = int((height + size) / 2)
 
-        logging.debug('Cropping %i %i %i %i', left, top, right, bottom)
-        cropped = img.crop((left, top, right, bottom))
-        img.close()
+def _create_all(path_in, targets, angle=None, mirror=None):
+    '''Decode the image once and write all targets from it.
+    @param path_in: str - the image to read
+    @param targets: list(tuple(purpose, path_out, size)) - "check" targets
+        are cropped 1:1 from the center of the full resolution image, the
+        rest are downscaled so that their longest edge is size, smaller ones
+        from the larger ones
+    @param angle: int - rotate with this angle
+    @param mirror: str - mirror in this direction, None, "H" or "V"
+    '''
+    img = Image.open(path_in)
+    width, height = img.size
+
+    checks = [target for target in targets if target[0] == 'check']
+    rescaled = [target for target in targets if target[0] != 'check']
+
+    if checks and rescaled and img.format == 'JPEG':
+        # A reduced decode is much cheaper for the rescaled targets, so the
+        # checks get a full resolution decode of their own
+        full = Image.open(path_in)
+        _create_checks(full, checks, angle, mirror)
+        full.close()
+        checks = []
+
+    # Decode no more than the largest rescaled target needs
+    if rescaled:
+        _shrink_on_load(img, _get_box(width, height, max(t[2] for t in rescaled)))
+    img.load()
+
+    _create_checks(img, checks, angle, mirror)
+
+    for purpose, path_out, longest_edge in sorted(rescaled, key=lambda t: -t[2]):
+        os.makedirs(os.path.dirname(path_out), exist_ok=True)
+        with open(path_out, 'wb') as out:
+            box = _get_box(width, height, longest_edge)
+            _downscale(img, box)
+            _orient(img, angle, mirror).save(out, "JPEG", quality=90)
+        logging.info("Created image %s", path_out)
 
-        if mirror == 'H':
-            cropped = cropped.transpose(Image.FLIP_RIGHT_LEFT)
-        elif mirror == 'V':
-            cropped = cropped.transpose(Image.FLIP_TOP_BOTTOM)
-        if angle:
-            logging.debug('Rotating by %i degrees', angle)
-            cropped = cropped.rotate(angle)
+    img.close()
 
-        cropped.save(out, "JPEG", quality=98)
-        cropped.close()
+
+def _create_checks(img, checks, angle, mirror):
+    for purpose, path_out, size in checks:
+        os.makedirs(os.path.dirname(path_out), exist_ok=True)
+        with open(path_out, 'wb') as out:
+            _crop(img, size, out, angle, mirror)
         logging.debug("Created check %s", path_out)
-        return size, size
+
+
+def _crop(img, size, out, angle, mirror):
+    width, height = img.size
+
+    left = int((width - size) / 2)
+    top = int((height - size) / 2)
+    right = int((width + size) / 2)
+    bottom = int((height + size) / 2)
+
+    logging.debug('Cropping %i %i %i %i', left, top, right, bottom)
+    cropped = img.crop((left, top, right, bottom))
+
+    if mirror == 'H':
+        cropped = cropped.transpose(Image.FLIP_RIGHT_LEFT)
+    elif mirror == 'V':
+        cropped = cropped.transpose(Image.FLIP_TOP_BOTTOM)
+    if angle:
+        logging.debug('Rotating by %i degrees', angle)
+        cropped = cropped.rotate(angle)
+
+    cropped.save(out, "JPEG", quality=98)
+    cropped.close()
+
+
+def _get_box(width, height, longest_edge):
+    if width > height:
+        scale = float(longest_edge) / float(width)
+    else:
+        scale = float(longest_edge) / float(height)
+    return int(width * scale), int(height * scale)
 
 
 def _convert(path_in, path_out, longest_edge=1280, angle=None, mirror=None):
     os.makedirs(os.path.dirname(path_out), exist_ok=True)
 
-    with open(path_out, 'w') as out:
+    with open(path_out, 'wb') as out:
         img = Image.open(path_in)
-        width, height = img.size
-        if width > height:
-            scale = float(longest_edge) / float(width)
-        else:
-            scale = float(longest_edge) / float(height)
-        w = int(width * scale)
-        h = int(height * scale)
+        w, h = _get_box(*img.size, longest_edge)
+        _shrink_on_load(img, (w, h))
         logging.debug('_resize %i %i %i', h, w, angle)
         _resize(img, (w, h), out, angle, mirror)
         logging.info("Created image %s", path_out)
         return w, h
 
 
+def _shrink_on_load(img, box):
+    '''Have the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding,
+    as far as possible while still covering box. Must be called before the
+    image is loaded. Other formats are decoded in full as before.
+    @param img: Image - an Image-object that is not loaded yet
+    @param box: tuple(x, y) - the smallest size that is needed
+    '''
+    if img.format != 'JPEG':
+        return
+    img.draft(img.mode, box)
+    logging.debug('Decoding at %ix%i', img.size[0], img.size[1])
+
+
 def _resize(img, box, out, angle, mirror):
     '''Downsample the image.
     @param img: Image -  an Image-object
@@ -233,6 +351,15 @@ def _resize(img, box, out, angle, mirror):
     @param angle: int - rotate with this angle
     @param mirror: str - mirror in this direction, None, "H" or "V"
     '''
+    _downscale(img, box)
+    img = _orient(img, angle, mirror)
+
+    # Save it into a file-like object
+    img.save(out, "JPEG", quality=90)
+
+
+def _downscale(img, box):
+    '''Downsample the image in place to fit within box.'''
     # Preresize image with factor 2, 4, 8 and fast algorithm
     factor = 1
     bw, bh = box
@@ -247,6 +374,9 @@ def _resize(img, box, out, angle, mirror):
     # Resize the image with best quality algorithm ANTI-ALIAS
     logging.debug('Final scale down to %ix%i', box[0], box[1])
     img.thumbnail(box, Image.ANTIALIAS)
+
+
+def _orient(img, angle, mirror):
     if mirror == 'H':
         img = img.transpose(Image.FLIP_RIGHT_LEFT)
     elif mirror == 'V':
@@ -254,6 +384,4 @@ def _resize(img, box, out, angle, mirror):
     if angle:
         logging.debug('Rotating by %i degrees', angle)
         img = img.rotate(angle, resample=Image.BICUBIC, expand=True)
-
-    # Save it into a file-like object
-    img.save(out, "JPEG", quality=90)
+    return img
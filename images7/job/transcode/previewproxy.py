@@ -0,0 +1,143 @@
+import io
+import os
+import logging
+import exifread
+from PIL import Image
+
+from images7.job.transcode import register_transcoder
+from images7.job.transcode.imageproxy import ImageTranscoder, _create_all
+from images7.multi import offload
+
+
+class PreviewTranscoder(ImageTranscoder):
+    """
+    Create thumbs and proxies from the largest JPEG preview embedded in the
+    file when it covers the largest of them, and decode the file itself for
+    the rest.
+    """
+    full_decode = True
+
+    def run_many(self, options_list):
+        logging.info('Starting preview image transaction.')
+        entry, targets = self.prepare(options_list)
+        angle = getattr(entry.metadata, 'angle', 0)
+        mirror = getattr(entry.metadata, 'mirror', 0)
+
+        preview_path = self.full_original_file_path + '_preview'
+        preview_size = offload(_extract_preview, self.full_original_file_path, preview_path)
+        longest_edge = max(preview_size) if preview_size is not None else 0
+
+        rescaled = [t for t in targets if t is not None and t[0] != 'check']
+        checks = [t for t in targets if t is not None and t[0] == 'check']
+        if self.full_decode and any(t[2] > longest_edge for t in rescaled):
+            # The file is decoded anyway, no use for the preview then
+            from_preview, from_full = [], rescaled + checks
+        elif self.full_decode:
+            from_preview, from_full = rescaled, checks
+        else:
+            from_preview = [t for t in rescaled if t[2] <= longest_edge]
+            from_full = []
+            for target in checks + [t for t in rescaled if t[2] > longest_edge]:
+                logging.info("No preview large enough for %s.", target[0])
+
+        if from_preview:
+            offload(_create_all, preview_path, from_preview, angle=angle, mirror=mirror)
+        if from_full:
+            offload(_create_all, self.full_original_file_path, from_full, angle=angle, mirror=mirror)
+
+        if preview_size is not None:
+            os.remove(preview_path)
+
+        return self.store_all(entry, targets)
+
+
+class RawPreviewTranscoder(PreviewTranscoder):
+    # Pillow can not decode these, so the embedded preview is all there is
+    full_decode = False
+
+
+# Replaces the plain ImageTranscoder, which is registered for JPEG on import
+register_transcoder('image/jpeg', 'proxy', PreviewTranscoder)
+register_transcoder('image/dng', 'proxy', RawPreviewTranscoder)
+register_transcoder('image/cr2', 'proxy', RawPreviewTranscoder)
+register_transcoder('image/raf', 'proxy', RawPreviewTranscoder)
+
+
+def _extract_preview(path_in, path_out):
+    '''Write the largest embedded JPEG preview of a file to path_out.
+    @param path_in: str - a JPEG, TIFF-based RAW (DNG, CR2) or RAF file
+    @param path_out: str - where to write the preview
+    @return: tuple(width, height) of the preview or None if there is none
+    '''
+    best = None
+    best_size = None
+    for data in _find_previews(path_in):
+        try:
+            size = Image.open(io.BytesIO(data)).size
+        except IOError:
+            continue
+        if best_size is None or size[0] * size[1] > best_size[0] * best_size[1]:
+            best, best_size = data, size
+
+    if best is None:
+        logging.debug('No embedded preview in %s', path_in)
+        return None
+
+    os.makedirs(os.path.dirname(path_out), exist_ok=True)
+    with open(path_out, 'wb') as out:
+        out.write(best)
+    logging.debug('Extracted %ix%i preview from %s', best_size[0], best_size[1], path_in)
+    return best_size
+
+
+def _find_previews(path):
+    with open(path, 'rb') as f:
+        magic = f.read(16)
+
+        # Fujifilm RAF has a pointer to a full JPEG in its header
+        if magic.startswith(b'FUJIFILMCCD-RAW'):
+            f.seek(84)
+            header = f.read(8)
+            offset = int.from_bytes(header[:4], 'big')
+            length = int.from_bytes(header[4:], 'big')
+            yield _read_jpeg(f, offset, length)
+            return
+
+        # JPEG files only have the thumbnail in their EXIF block, there is no
+        # need to read the maker notes to get it
+        is_tiff = magic[:4] in (b'II*\x00', b'MM\x00*')
+        if not is_tiff and not magic.startswith(b'\xff\xd8'):
+            return
+
+        f.seek(0)
+        try:
+            tags = exifread.process_file(f, details=is_tiff)
+        except Exception as e:
+            logging.debug('Could not read EXIF from %s (%s)', path, str(e))
+            return
+        if 'JPEGThumbnail' in tags:
+            yield tags['JPEGThumbnail']
+
+        # In TIFF-based RAW files (offset 0) IFD0 often holds a large preview
+        if not is_tiff:
+            return
+
+        compression = tags.get('Image Compression')
+        if compression is not None and compression.values[0] in (6, 7):
+            offsets = tags.get('Image StripOffsets')
+            lengths = tags.get('Image StripByteCounts')
+            if offsets is not None and lengths is not None and len(offsets.values) == 1:
+                yield _read_jpeg(f, offsets.values[0], lengths.values[0])
+
+        offset = tags.get('Image JPEGInterchangeFormat')
+        length = tags.get('Image JPEGInterchangeFormatLength')
+        if offset is not None and length is not None:
+            yield _read_jpeg(f, offset.values[0], length.values[0])
+
+
+def _read_jpeg(f, offset, length):
+    f.seek(offset)
+    data = f.read(length)
+    if data[:2] != b'\xff\xd8':
+        return b''
+    return data
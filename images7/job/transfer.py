@@ -14,8 +14,8 @@ from images7.job.transcode import get_transcoder
 from images7.localfile import FileCopy, mangle, calculate_hash
 from images7.files import get_file_by_url, create_file, File, FileStatus
 from images7.analyse import get_analyser
-from images7.entry import get_entry_by_id, update_entry_by_id, FilePurpose, FileReference
-from images7.retry import retry, GiveUp
+from images7.entry import get_entry_by_id, merge_entry_metadata, append_file_references, FilePurpose, FileReference
+from images7.retry import GiveUp
 
 
 class TransferOptions(PropertySet):
@@ -37,7 +37,7 @@ class TransferJobHandler(JobHandler):
         logging.info('Starting transfer')
         assert job is not None, "Job can't be None"
         assert job.options is not None, "Job Options can't be None"
-        logging.info('Job\n%s', job.to_json())
+        logging.debug('Job\n%s', job.to_json())
         self.system = current_system()
         self.options = job.options
         self.source = get_file_by_url(self.options.source_url)
@@ -80,16 +80,7 @@ class TransferJobHandler(JobHandler):
         if metadata is None:
             return
         
-        @retry()
-        def push():
-            entry = get_entry_by_id(self.options.entry_id)
-            if entry.metadata is None:
-                entry.metadata = metadata
-            else:
-                entry.metadata.merge(metadata)
-            update_entry_by_id(entry.id, entry)
-        
-        push()
+        merge_entry_metadata(self.options.entry_id, metadata)
 
 
     def to_main(self):
@@ -123,27 +114,20 @@ class TransferJobHandler(JobHandler):
         )
         filecopy.run()
 
-        @retry()
-        def push():
-            entry = get_entry_by_id(self.options.entry_id)
-            new_file_ref = FileReference(
-                purpose=file_ref.purpose,
-                version=file_ref.version,
-                reference=self.reference,
-                mime_type=file_ref.mime_type,
-            )
-            new_file = File(
-                reference=self.reference,
-                url=self.system.main_storage.get_file_url(main_path),
-                mime_type=self.source.mime_type,
-                status=FileStatus.managed,
-            )
-            create_file(new_file)
-
-            entry.files.append(new_file_ref)
-            update_entry_by_id(entry.id, entry)
-
-        push()
+        new_file = File(
+            reference=self.reference,
+            url=self.system.main_storage.get_file_url(main_path),
+            mime_type=self.source.mime_type,
+            status=FileStatus.managed,
+        )
+        create_file(new_file)
+
+        append_file_references(self.options.entry_id, [FileReference(
+            purpose=file_ref.purpose,
+            version=file_ref.version,
+            reference=self.reference,
+            mime_type=file_ref.mime_type,
+        )])
 
 
     def to_cut(self):
@@ -181,9 +165,9 @@ class TransferJobHandler(JobHandler):
         transcoder = get_transcoder(entry.type.value + '-proxy')
 
         targets = [
-            transcoder.Options(entry=entry, cut_source=self.cut_path, purpose=FilePurpose.proxy),
-            transcoder.Options(entry=entry, cut_source=self.cut_path, purpose=FilePurpose.thumb),
-            transcoder.Options(entry=entry, cut_source=self.cut_path, purpose=FilePurpose.check), # clean_up=True
+            transcoder.Options(entry_id=entry.id, cut_source=self.cut_path, purpose=FilePurpose.proxy),
+            transcoder.Options(entry_id=entry.id, cut_source=self.cut_path, purpose=FilePurpose.thumb),
+            transcoder.Options(entry_id=entry.id, cut_source=self.cut_path, purpose=FilePurpose.check), # clean_up=True
         ]
 
         filerefs = []
@@ -3,10 +3,28 @@
 
 import os
 import errno
+import json
 import logging
 import shutil
 import re
 import hashlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+BLOCKSIZE = 65636
+HEADER_SIZE = 262144
+FINGERPRINT_SIZE = 65536
+FICLONE = 0x40049409  # from linux/fs.h
+SYNC_BATCH = 64
+SYNC_AGE = 5.0
 
 
 class FileCopy(object):
@@ -24,8 +42,9 @@ class FileCopy(object):
 
     def run(self):
         destination_folder = os.path.dirname(self.destination)
-        os.makedirs(destination_folder, exist_ok=True)
+        ensure_folder(destination_folder)
 
+        retried = False
         while True:
             try:
                 if self.link:
@@ -33,45 +52,189 @@ class FileCopy(object):
                     os.link(self.source, self.destination)
                 else:
                     logging.debug("Copying %s -> %s", self.source, self.destination)
-                    shutil.copy2(self.source, self.destination)
+                    copy_file(self.source, self.destination)
                 break
             except OSError as e:
                 if e.errno == errno.EXDEV:
                     logging.warning("Cross-device link %s -> %s", self.source, self.destination)
                     self.link = False
+                elif (e.errno == errno.ENOENT and not retried
+                        and not os.path.isdir(destination_folder)
+                        and os.path.exists(self.source)):
+                    logging.warning("Folder %s disappeared, creating it again", destination_folder)
+                    forget_folder(destination_folder)
+                    ensure_folder(destination_folder)
+                    retried = True
                 else:
                     logging.warning("OSError %i %s -> %s (%s)", e.errno, self.source, self.destination, str(e))
                     raise e
 
+        sync_later(self.destination)
+
         if self.remove_source:
             logging.debug("Removing source %s", self.source)
             os.remove(self.source)
 
 
+class TeeCopy(object):
+    """
+    Copy a file while hashing it, reading the source only once.
+
+    The first ``header_size`` bytes are kept in memory so that metadata can be
+    parsed from them without opening the source (or the copy) again.
+    """
+
+    def __init__(
+            self,
+            source=None,
+            destination=None,
+            header_size=HEADER_SIZE):
+
+        self.source = source
+        self.destination = destination
+        self.header_size = header_size
+
+        self.calculated_hash = None
+        self.fingerprint = None
+        self.header = None
+        self.size = 0
+
+    def run(self):
+        destination_folder = os.path.dirname(self.destination)
+        ensure_folder(destination_folder)
+
+        logging.debug("Tee-copying %s -> %s", self.source, self.destination)
+        sha = hashlib.sha256()
+        header = bytearray()
+        tail = bytearray()
+        size = 0
+        with open(self.source, 'rb') as src, open(self.destination, 'wb') as dst:
+            _preallocate(dst, os.fstat(src.fileno()).st_size)
+            buf = src.read(BLOCKSIZE)
+            while len(buf) > 0:
+                sha.update(buf)
+                dst.write(buf)
+                if len(header) < max(self.header_size, FINGERPRINT_SIZE):
+                    header.extend(buf[:max(self.header_size, FINGERPRINT_SIZE) - len(header)])
+                tail.extend(buf)
+                del tail[:-FINGERPRINT_SIZE]
+                size += len(buf)
+                buf = src.read(BLOCKSIZE)
+            dst.truncate(size)
+        shutil.copystat(self.source, self.destination)
+
+        tail_size = min(FINGERPRINT_SIZE, max(0, size - FINGERPRINT_SIZE))
+        self.calculated_hash = sha.hexdigest()
+        self.fingerprint = make_fingerprint(size, bytes(header[:FINGERPRINT_SIZE]), bytes(tail[len(tail) - tail_size:]))
+        self.header = bytes(header[:self.header_size])
+        self.size = size
+
+
 class FolderScanner(object):
-    def __init__(self, basepath, extensions=None):
+    """
+    Find files below basepath, scanning sub-folders in parallel.
+
+    If a FolderSnapshot is given, only files that are new or have changed
+    size or mtime since the snapshot was saved are reported. They are noted
+    as seen in the snapshot, confirming and saving them is up to the caller.
+    """
+
+    def __init__(self, basepath, extensions=None, snapshot=None, threads=4):
         self.basepath = basepath
         if extensions is None:
             self.extensions = None
         else:
-            self.extensions = [e.lower() for e in extensions]
-            self.extensions = [e if e.startswith('.') else ('.' + e) for e in self.extensions]
-            self.extensions.extend([e.upper() for e in self.extensions])
+            self.extensions = {e.lower() for e in extensions}
+            self.extensions = {e if e.startswith('.') else ('.' + e) for e in self.extensions}
+        self.snapshot = snapshot
+        self.threads = threads
         logging.debug('Scanning for file-extensions %s', str(self.extensions))
 
     def scan(self):
-        for relative_path, directories, files in os.walk(self.basepath, followlinks=True):
-            logging.debug('Scanning %s', relative_path)
-            for f in files:
-                if self.extensions is None or any(map(lambda e: f.endswith(e), self.extensions)):
-                    path = os.path.relpath(os.path.join(relative_path, f), self.basepath)
-                    if not path.startswith('.'):
-                        yield path
+        for folder, paths in self.scan_folders():
+            for path in paths:
+                yield path
+
+    def scan_folders(self):
+        """Like scan(), but yield (folder, paths) with all files of a folder
+        at once, folder being relative to basepath."""
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            pending = deque([pool.submit(self._scan_folder, self.basepath)])
+            while pending:
+                folder, files, folders = pending.popleft().result()
+                for subfolder in folders:
+                    pending.append(pool.submit(self._scan_folder, subfolder))
+                paths = []
+                for path, size, mtime in files:
+                    if self.snapshot is not None:
+                        if not self.snapshot.is_changed(path, size, mtime):
+                            continue
+                        self.snapshot.seen(path, size, mtime)
+                    paths.append(path)
+                if paths:
+                    yield folder, paths
 
+    def _scan_folder(self, folder):
+        logging.debug('Scanning %s', folder)
+        files = []
+        folders = []
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    path = os.path.relpath(entry.path, self.basepath)
+                    if path.startswith('.'):
+                        continue
+                    if entry.is_dir():
+                        folders.append(entry.path)
+                    elif self.extensions is None or os.path.splitext(entry.name)[1].lower() in self.extensions:
+                        stat = entry.stat()
+                        files.append((path, stat.st_size, stat.st_mtime))
+        except OSError as e:
+            logging.warning("Could not scan %s (%s)", folder, str(e))
+        return os.path.relpath(folder, self.basepath), files, folders
+
+
+class FolderSnapshot(object):
+    """
+    Size and mtime of the files in a folder, kept in a JSON file.
+
+    Files are only kept once confirmed, so that a file that is seen but not
+    taken care of is reported again by the next scan.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.files = {}
+        self.pending = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.files = json.load(f)
+
+    def is_changed(self, path, size, mtime):
+        return self.files.get(path) != [size, mtime]
+
+    def seen(self, path, size, mtime):
+        with self.lock:
+            self.pending[path] = [size, mtime]
+
+    def confirm(self, paths):
+        with self.lock:
+            for path in paths:
+                stat = self.pending.pop(path, None)
+                if stat is not None:
+                    self.files[path] = stat
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with self.lock:
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self.files, f)
+            os.replace(self.filename + '.tmp', self.filename)
+        logging.debug('Saved snapshot %s', self.filename)
 
 
 def calculate_hash(path):
-    BLOCKSIZE = 65636
     sha = hashlib.sha256()
     with open(path, 'rb') as f:
         buf = f.read(BLOCKSIZE)
@@ -82,6 +245,173 @@ def calculate_hash(path):
     return sha.hexdigest()
 
 
+def copy_file(source, destination):
+    """
+    Copy contents and stat like shutil.copy2, but let the kernel do the work.
+
+    A reflink is tried first, which shares the data blocks on file systems
+    that support it (btrfs, XFS). Otherwise the destination is pre-allocated
+    and the data copied with copy_file_range or sendfile, falling back to
+    plain reads and writes.
+    """
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        if not _reflink(src, dst):
+            size = os.fstat(src.fileno()).st_size
+            _preallocate(dst, size)
+            dst.truncate(_copy_range(src, dst, size))
+    shutil.copystat(source, destination)
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _preallocate(dst, size):
+    if size == 0 or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(dst.fileno(), 0, size)
+    except OSError:
+        pass
+
+
+_unsupported = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+def _copy_range(src, dst, size):
+    offset = 0
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), size - offset, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            if offset >= size:
+                return offset
+        except OSError as e:
+            if e.errno not in _unsupported:
+                raise
+
+    if hasattr(os, 'sendfile'):
+        try:
+            dst.seek(offset)
+            while offset < size:
+                copied = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            if offset >= size:
+                return offset
+        except OSError as e:
+            if e.errno not in _unsupported:
+                raise
+
+    src.seek(offset)
+    dst.seek(offset)
+    buf = src.read(BLOCKSIZE)
+    while len(buf) > 0:
+        dst.write(buf)
+        offset += len(buf)
+        buf = src.read(BLOCKSIZE)
+    return offset
+
+
+_folders = set()
+_folders_lock = threading.Lock()
+
+
+def ensure_folder(path):
+    """Create path unless this process already has."""
+    if path in _folders:
+        return
+    os.makedirs(path, exist_ok=True)
+    with _folders_lock:
+        _folders.add(path)
+
+
+def forget_folder(path):
+    """Forget that path was created. Return True if it was known."""
+    with _folders_lock:
+        if path in _folders:
+            _folders.remove(path)
+            return True
+    return False
+
+
+# Copies are not synced one by one. They are collected here and synced as a
+# group when enough of them have piled up or the oldest one is old enough.
+
+_pending_sync = set()
+_pending_since = None
+_sync_lock = threading.Lock()
+
+
+def sync_later(path):
+    global _pending_since
+    with _sync_lock:
+        if not _pending_sync:
+            _pending_since = time.monotonic()
+        _pending_sync.add(path)
+
+
+def sync_pending(force=False):
+    """Sync the files waiting for it, and their folders, if it is time."""
+    global _pending_since
+    with _sync_lock:
+        if not _pending_sync:
+            return
+        if not force and len(_pending_sync) < SYNC_BATCH and time.monotonic() - _pending_since < SYNC_AGE:
+            return
+        paths = list(_pending_sync)
+        _pending_sync.clear()
+        _pending_since = None
+
+    logging.debug('Syncing %d files', len(paths))
+    for path in paths + list({os.path.dirname(p) for p in paths}):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            logging.warning('Could not sync %s (%s)', path, str(e))
+        finally:
+            os.close(fd)
+
+
+def calculate_fingerprint(path):
+    """
+    Cheap stand-in for the full hash, made from the size and the first and
+    last FINGERPRINT_SIZE bytes. Files with different fingerprints are
+    different, files with the same fingerprint are probably the same.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(FINGERPRINT_SIZE)
+        tail = b''
+        if size > FINGERPRINT_SIZE:
+            f.seek(max(FINGERPRINT_SIZE, size - FINGERPRINT_SIZE))
+            tail = f.read(FINGERPRINT_SIZE)
+
+    return make_fingerprint(size, head, tail)
+
+
+def make_fingerprint(size, head, tail):
+    sha = hashlib.sha256()
+    sha.update(head)
+    sha.update(tail)
+    return '%d:%s' % (size, sha.hexdigest())
+
+
 mangled = re.compile(r'[^A-Za-z0-9-_]')
 mangled_with_dots = re.compile(r'[^A-Za-z0-9-_.]')
 
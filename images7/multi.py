@@ -1,9 +1,68 @@
+import os
+import heapq
+import itertools
 import threading
 import time
 import logging
+import multiprocessing
 import zmq
 import uuid
-from collections import OrderedDict
+from collections import OrderedDict, deque, defaultdict, Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+
+class ConnectionPool(object):
+    """
+    Connected sockets per socket type and endpoint, shared by all threads
+    in the process.
+
+    A socket is only used by one thread at a time: it is taken out of the
+    pool with acquire() and put back with release(). Sockets that are in a
+    bad state, like a REQ socket that never got its reply, are released
+    with broken=True and closed instead.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.lock = threading.Lock()
+        self.free = defaultdict(list)
+
+    def acquire(self, socket_type, endpoint):
+        with self.lock:
+            free = self.free[(socket_type, endpoint)]
+            if free:
+                return free.pop()
+        socket = self.context.socket(socket_type)
+        socket.connect(endpoint)
+        logging.debug('Connected new socket to %s', endpoint)
+        return socket
+
+    def release(self, socket, socket_type, endpoint, broken=False):
+        if broken:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.close()
+            return
+        with self.lock:
+            self.free[(socket_type, endpoint)].append(socket)
+
+    @contextmanager
+    def connection(self, socket_type, endpoint):
+        socket = self.acquire(socket_type, endpoint)
+        try:
+            yield socket
+        except:
+            self.release(socket, socket_type, endpoint, broken=True)
+            raise
+        else:
+            self.release(socket, socket_type, endpoint)
+
+    def close(self):
+        with self.lock:
+            for sockets in self.free.values():
+                for socket in sockets:
+                    socket.close()
+            self.free.clear()
 
 
 class QueueClient(threading.Thread):
@@ -13,18 +72,13 @@ class QueueClient(threading.Thread):
         threading.Thread.__init__(self)
 
     def _setup(self):
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.DEALER)
-        identity = 'client-%s' % str(self.id)
-        self.socket.identity = identity.encode('ascii')
-        self.socket.connect(self.address)
-        logging.debug("Client %s started at %s", identity, self.address)
-        poll = zmq.Poller()
-        poll.register(self.socket, zmq.POLLIN)
+        from images7.system import current_system
+        self.pool = current_system().zmq_pool
+        self.socket = self.pool.acquire(zmq.DEALER, self.address)
+        logging.debug("Client %s using %s", str(self.id), self.address)
 
     def _close(self):
-        self.socket.close()
-        self.context.term()
+        self.pool.release(self.socket, zmq.DEALER, self.address)
 
     def run(self):
         self._setup()
@@ -41,6 +95,9 @@ class QueueClient(threading.Thread):
         pass # override this!
 
     def send(self, request):
+        if hasattr(request, 'to_bytes'):
+            self.socket.send(request.to_bytes())
+            return
         if hasattr(request, 'to_json'):
             request = request.to_json()
         self.socket.send_string(request)
@@ -50,19 +107,39 @@ class QueueClient(threading.Thread):
         return self
 
 
+READY = b'READY'
+
+
 class QueueServer(threading.Thread):
+    """
+    Load-aware broker between the clients and the workers.
+
+    Workers announce themselves with a READY message when they start and
+    every time they finish a job, and the broker only hands out work to
+    workers that are idle. Everything else waits in the pending queue.
+    """
+
+    poll_timeout = None
+
     def __init__(self, address, Worker, workers=4):
         self.address = address
         self.Worker = Worker
         self.workers = workers
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.idle = deque()
+        self.busy_since = {}
+        self.busy_time = OrderedDict()
+        self.jobs_done = OrderedDict()
         threading.Thread.__init__(self)
 
     def run(self):
-        context = zmq.Context()
+        from images7.system import current_system
+        context = current_system().zmq_context
         frontend = context.socket(zmq.ROUTER)
         frontend.bind(self.address)
 
-        backend = context.socket(zmq.DEALER)
+        backend = context.socket(zmq.ROUTER)
         backend.bind('inproc://backend')
 
         workers = []
@@ -71,11 +148,81 @@ class QueueServer(threading.Thread):
             worker.start()
             workers.append(worker)
 
-        zmq.proxy(frontend, backend)
+        poll = zmq.Poller()
+        poll.register(frontend, zmq.POLLIN)
+        poll.register(backend, zmq.POLLIN)
+
+        while True:
+            socks = dict(poll.poll(self.poll_timeout))
+
+            if socks.get(backend) == zmq.POLLIN:
+                worker_id, _ = backend.recv_multipart()
+                self._ready(worker_id)
+
+            if socks.get(frontend) == zmq.POLLIN:
+                client_id, message = frontend.recv_multipart()
+                self.enqueue(client_id, message)
+
+            while self.idle:
+                task = self.dequeue()
+                if task is None:
+                    break
+                client_id, message = task
+                with self.lock:
+                    worker_id = self.idle.popleft()
+                    self.busy_since[worker_id] = time.time()
+                backend.send_multipart([worker_id, client_id, message])
 
         frontend.close()
         backend.close()
-        context.term()
+
+    def enqueue(self, client_id, message):
+        with self.lock:
+            self.pending.append((client_id, message))
+
+    def dequeue(self):
+        """Return the next (client_id, message) to hand out, or None."""
+        with self.lock:
+            if not self.pending:
+                return None
+            return self.pending.popleft()
+
+    def count_pending(self):
+        return len(self.pending)
+
+    def _ready(self, worker_id):
+        with self.lock:
+            started = self.busy_since.pop(worker_id, None)
+            if started is None:
+                logging.debug('Worker %s signed up', worker_id.decode('ascii'))
+                self.busy_time.setdefault(worker_id, 0.0)
+                self.jobs_done.setdefault(worker_id, 0)
+            else:
+                self.busy_time[worker_id] += time.time() - started
+                self.jobs_done[worker_id] += 1
+            self.idle.append(worker_id)
+
+    def depth(self):
+        """Number of jobs waiting for or being worked on."""
+        with self.lock:
+            return self.count_pending() + len(self.busy_since)
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            workers = OrderedDict()
+            for worker_id, busy_time in self.busy_time.items():
+                started = self.busy_since.get(worker_id)
+                workers[worker_id.decode('ascii')] = {
+                    'busy': started is not None,
+                    'busy_time': busy_time + (now - started if started is not None else 0.0),
+                    'jobs_done': self.jobs_done[worker_id],
+                }
+            return {
+                'pending': self.count_pending(),
+                'idle': len(self.idle),
+                'workers': workers,
+            }
 
 
 class QueueWorker(threading.Thread):
@@ -85,15 +232,150 @@ class QueueWorker(threading.Thread):
 
     def run(self):
         worker = self.context.socket(zmq.DEALER)
+        worker.identity = self.name.encode('ascii')
         worker.connect('inproc://backend')
         logging.debug('Worker started')
+        worker.send(READY)
 
         while True:
             ident, msg = worker.recv_multipart()
             logging.debug('Message from %s:\n%s', ident.decode('ascii'), msg.decode('utf8'))
-            self.work(msg)
+            try:
+                self.work(msg)
+            except Exception:
+                logging.exception('Worker %s failed', self.name)
+            worker.send(READY)
 
         worker.close()
 
     def work(self, message):
         pass # override this!
+
+
+# PROCESS OFFLOADING
+####################
+
+_process_pool = None
+_process_methods = set()
+_current = threading.local()
+
+
+def setup_process_pool(processes=None, methods=None):
+    """
+    Start a process pool for the CPU-bound parts of the given job methods.
+
+    The pool is forked from a clean forkserver process, not from the
+    multi-threaded server, so offloaded functions must be importable.
+    """
+    global _process_pool, _process_methods
+    _process_methods = set(methods or [])
+    if not _process_methods:
+        return
+    logging.info('Starting process pool for %s', ', '.join(sorted(_process_methods)))
+    _process_pool = ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('forkserver'),
+    )
+
+
+def set_current_method(method):
+    _current.method = method
+
+
+def offload(function, *args, **kwargs):
+    """
+    Run function in the process pool if the job step running in this thread
+    is configured for it, otherwise run it right here.
+    """
+    method = getattr(_current, 'method', None)
+    if _process_pool is None or method not in _process_methods:
+        return function(*args, **kwargs)
+    return _process_pool.submit(function, *args, **kwargs).result()
+
+
+# DEVICE SCHEDULING
+###################
+
+
+class DeviceGate(object):
+    """
+    Let at most limit threads do I/O on each device at the same time.
+
+    Waiters are let through in inode order of the first path, so that reads
+    from the same card move forward over the card instead of jumping back
+    and forth. Only waiters that arrived within the same window of time are
+    sorted like that, earlier windows go first, so a waiter with a high
+    inode can not be kept waiting by a steady stream of lower ones. A
+    waiter that needs several devices waits until it is first in line on
+    all of them, which can not deadlock as the order is the same on every
+    device.
+    """
+
+    window = 0.5  # seconds
+
+    def __init__(self, limit=2):
+        self.limit = limit
+        self.condition = threading.Condition()
+        self.active = Counter()
+        self.waiting = defaultdict(list)
+        self.sequence = itertools.count()
+
+    @contextmanager
+    def slot(self, *paths):
+        devices, inode = _stat_paths(paths)
+        ticket = (int(time.monotonic() / self.window), inode, next(self.sequence))
+
+        with self.condition:
+            for device in devices:
+                heapq.heappush(self.waiting[device], ticket)
+            while not all(self._is_next(device, ticket) for device in devices):
+                self.condition.wait()
+            for device in devices:
+                heapq.heappop(self.waiting[device])
+                self.active[device] += 1
+
+        try:
+            yield
+        finally:
+            with self.condition:
+                for device in devices:
+                    self.active[device] -= 1
+                self.condition.notify_all()
+
+    def _is_next(self, device, ticket):
+        return self.active[device] < self.limit and self.waiting[device][0] == ticket
+
+
+def _stat_paths(paths):
+    devices = set()
+    inode = None
+    for path in paths:
+        while True:
+            try:
+                stat = os.stat(path)
+                break
+            except FileNotFoundError:
+                parent = os.path.dirname(path)
+                if parent == path:
+                    raise
+                path = parent
+        devices.add(stat.st_dev)
+        if inode is None:
+            inode = stat.st_ino
+    return sorted(devices), inode or 0
+
+
+_device_gate = DeviceGate()
+
+
+def setup_device_gate(limit):
+    _device_gate.limit = limit
+
+
+def device_slot(*paths):
+    """
+    Wait for a turn to do I/O on the devices holding the given paths.
+    Paths that do not exist yet count as the device of their closest
+    existing parent.
+    """
+    return _device_gate.slot(*paths)
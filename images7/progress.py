@@ -0,0 +1,64 @@
+"""Progress counters for work that is spread over many jobs, like imports."""
+
+import uuid
+import threading
+
+from jsonobject import PropertySet, Property, EnumProperty
+
+
+class ProgressStatus(EnumProperty):
+    scanning = 'scanning'
+    importing = 'importing'
+    done = 'done'
+
+
+class Progress(PropertySet):
+    id = Property()
+    scanned = Property(bool, default=False)
+    files_discovered = Property(int, default=0)
+    jobs_queued = Property(int, default=0)
+    jobs_done = Property(int, default=0)
+    failed = Property(int, default=0)
+    bytes_copied = Property(int, default=0)
+
+    status = Property(enum=ProgressStatus, calculated=True)
+    progress = Property(int, calculated=True)
+    self_url = Property(calculated=True)
+
+    def calculate(self, base):
+        finished = self.jobs_done + self.failed
+        if not self.scanned:
+            self.status = ProgressStatus.scanning
+        elif finished < self.jobs_queued:
+            self.status = ProgressStatus.importing
+        else:
+            self.status = ProgressStatus.done
+        self.progress = int(100 * finished / self.jobs_queued) if self.jobs_queued else 0
+        self.self_url = '%s/%s' % (base, self.id)
+
+
+_lock = threading.Lock()
+_progress = {}
+
+
+def create_progress() -> Progress:
+    progress = Progress(id=uuid.uuid4().hex)
+    with _lock:
+        _progress[progress.id] = progress
+    return progress
+
+
+def get_progress(id) -> Progress:
+    return _progress.get(id)
+
+
+def count(id, **deltas):
+    """Add to the counters of the progress with the given id, if any."""
+    if id is None:
+        return
+    with _lock:
+        progress = _progress.get(id)
+        if progress is None:
+            return
+        for key, delta in deltas.items():
+            setattr(progress, key, getattr(progress, key) + delta)
@@ -2,6 +2,7 @@
 
 
 from jsondb import Conflict
+import random
 import time
 
 
@@ -9,18 +10,49 @@ class GiveUp(Exception):
     pass
 
 
+class RetryLater(Exception):
+    """
+    Raised from a job step to have the job put back in the queue and the
+    step run again after delay seconds, doubling for every new attempt.
+    """
+
+    def __init__(self, reason=None, delay=1.0, max_retries=10):
+        super().__init__(reason)
+        self.delay = delay
+        self.max_retries = max_retries
+
+
 def retry(max_retries=10, timeout=30):
+    """Retry the job step on Conflict, waiting in the queue instead of
+    in the worker thread. Only for functions that update documents, a
+    Conflict from creating one that already exists will not go away."""
+    def wraps(func):
+        def inner(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except Conflict as e:
+                raise RetryLater('Conflict: %s' % str(e), delay=timeout, max_retries=max_retries)
+        return inner
+    return wraps
+
+
+def backoff(max_retries=20, initial=0.002, maximum=0.25):
+    """Retry on Conflict right away, then with jittered exponential backoff
+    starting at a couple of milliseconds."""
     def wraps(func):
         def inner(*args, **kwargs):
+            delay = initial
             for i in range(max_retries):
-                try:    
+                try:
                     result = func(*args, **kwargs)
                 except Conflict:
-                    time.sleep(timeout)
+                    if i > 0:
+                        time.sleep(random.uniform(0, delay))
+                        delay = min(delay * 2, maximum)
                     continue
                 else:
                     return result
             else:
-                raise GiveUp 
+                raise GiveUp
         return inner
-    return wraps
\ No newline at end of file
+    return wraps
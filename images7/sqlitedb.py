@@ -0,0 +1,328 @@
+"""SQLite storage engine with the same interface as jsondb.Database.
+
+Documents are stored as JSON in a table of their own and every view is a
+real table with one row per emitted key, indexed on the key and kept up to
+date on every save and delete. Keys are encoded into bytes that sort the
+same way as the keys themselves, so that key ranges become index seeks.
+"""
+
+
+import os
+import re
+import json
+import uuid
+import struct
+import hashlib
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from jsondb import Conflict
+
+
+_missing = object()
+CHUNK_SIZE = 500  # stay below SQLITE_MAX_VARIABLE_NUMBER
+valid_name = re.compile(r'^[A-Za-z0-9_]+$')
+
+
+class Database(object):
+    def __init__(self, path):
+        self.filename = path + '.sqlite'
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.views = {}
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+
+        conn = self.connection
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, rev INTEGER, doc TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS views (name TEXT PRIMARY KEY, version TEXT)')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(views)')]
+        if 'version' not in columns:
+            conn.execute('ALTER TABLE views ADD COLUMN version TEXT')
+
+    @property
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection
+        with self.write_lock:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except:
+                conn.execute('ROLLBACK')
+                raise
+            else:
+                conn.execute('COMMIT')
+
+    def define(self, name, map_function, reduce_function=None):
+        assert valid_name.match(name), 'Bad view name %s' % name
+        self.views[name] = (map_function, reduce_function)
+
+        table = _table(name)
+        with self.transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS %s (key BLOB, id TEXT, seq INTEGER, raw_key TEXT, value TEXT)' % table)
+            conn.execute('CREATE INDEX IF NOT EXISTS %s_key ON %s (key, id, seq)' % (table, table))
+            conn.execute('CREATE INDEX IF NOT EXISTS %s_id ON %s (id)' % (table, table))
+            built = conn.execute('SELECT version FROM views WHERE name = ?', (name, )).fetchone()
+            if built is None or built[0] != function_version(map_function):
+                self._build(conn, name)
+
+    def reindex(self, name):
+        with self.transaction() as conn:
+            self._build(conn, name)
+
+    def _build(self, conn, name):
+        logging.info('Building view %s in %s...', name, self.filename)
+        conn.execute('DELETE FROM %s' % _table(name))
+        for id, doc in conn.execute('SELECT id, doc FROM docs').fetchall():
+            self._index(conn, name, json.loads(doc))
+        conn.execute(
+            'INSERT OR REPLACE INTO views (name, version) VALUES (?, ?)',
+            (name, function_version(self.views[name][0]))
+        )
+        logging.info('Built view %s.', name)
+
+    def _index(self, conn, name, doc):
+        map_function, _ = self.views[name]
+        try:
+            result = map_function(doc)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            logging.debug('View %s skipped %s (%s)', name, doc.get('_id'), str(e))
+            return
+        if result is None:
+            return
+        rows = [result] if isinstance(result, tuple) else result
+        conn.executemany(
+            'INSERT INTO %s (key, id, seq, raw_key, value) VALUES (?, ?, ?, ?, ?)' % _table(name),
+            [
+                (encode_key(key), doc['_id'], seq, json.dumps(key), json.dumps(value))
+                for seq, (key, value) in enumerate(rows)
+            ]
+        )
+
+    def save(self, doc):
+        with self.transaction() as conn:
+            return self._save(conn, doc)
+
+    def save_many(self, docs):
+        """Save all docs in one transaction. A Conflict saves none of them."""
+        with self.transaction() as conn:
+            return [self._save(conn, doc) for doc in docs]
+
+    def _save(self, conn, doc):
+        doc = dict(doc)
+        if doc.get('_id') is None:
+            doc['_id'] = uuid.uuid4().hex
+        id = doc['_id']
+
+        row = conn.execute('SELECT rev FROM docs WHERE id = ?', (id, )).fetchone()
+        if row is not None and str(doc.get('_rev')) != str(row[0]):
+            raise Conflict(id)
+        doc['_rev'] = row[0] + 1 if row is not None else 1
+
+        conn.execute(
+            'INSERT OR REPLACE INTO docs (id, rev, doc) VALUES (?, ?, ?)',
+            (id, doc['_rev'], json.dumps(doc)),
+        )
+        for name in self.views.keys():
+            conn.execute('DELETE FROM %s WHERE id = ?' % _table(name), (id, ))
+            self._index(conn, name, doc)
+        return doc
+
+    def has(self, id):
+        return self.connection.execute('SELECT 1 FROM docs WHERE id = ?', (id, )).fetchone() is not None
+
+    def has_many(self, ids):
+        """Return the set of the given ids that exist."""
+        found = set()
+        for chunk in _chunks(list(ids), CHUNK_SIZE):
+            found.update(row[0] for row in self.connection.execute(
+                'SELECT id FROM docs WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk))
+        return found
+
+    def get_many(self, ids):
+        """Return a dict with the docs for the given ids that exist."""
+        docs = {}
+        for chunk in _chunks(list(ids), CHUNK_SIZE):
+            docs.update((row[0], json.loads(row[1])) for row in self.connection.execute(
+                'SELECT id, doc FROM docs WHERE id IN (%s)' % ','.join('?' * len(chunk)), chunk))
+        return docs
+
+    def __getitem__(self, id):
+        row = self.connection.execute('SELECT doc FROM docs WHERE id = ?', (id, )).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return json.loads(row[0])
+
+    def delete(self, id):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM docs WHERE id = ?', (id, ))
+            for name in self.views.keys():
+                conn.execute('DELETE FROM %s WHERE id = ?' % _table(name), (id, ))
+
+    def view(self, name, key=_missing, startkey=None, endkey=None,
+             include_docs=False, skip=0, limit=None, group=False,
+             descending=False):
+
+        _, reduce_function = self.views[name]
+        table = _table(name)
+
+        where = []
+        args = []
+        if key is not _missing:
+            where.append('v.key = ?')
+            args.append(encode_key(key))
+        else:
+            low, high = (endkey, startkey) if descending else (startkey, endkey)
+            if low is not None:
+                where.append('v.key >= ?')
+                args.append(encode_key(low))
+            if high is not None:
+                where.append('v.key <= ?')
+                args.append(encode_key(high))
+
+        order = 'DESC' if descending else 'ASC'
+        sql = 'SELECT v.raw_key, v.id, v.value%s FROM %s v%s%s ORDER BY v.key %s, v.id %s, v.seq %s' % (
+            ', d.doc' if include_docs else '',
+            table,
+            ' LEFT JOIN docs d ON d.id = v.id' if include_docs else '',
+            (' WHERE ' + ' AND '.join(where)) if where else '',
+            order, order, order,
+        )
+
+        if group and reduce_function is not None:
+            return _group(self.connection.execute(sql, args), reduce_function, skip, limit)
+
+        if limit is not None or skip:
+            sql += ' LIMIT ? OFFSET ?'
+            args += [-1 if limit is None else limit, skip or 0]
+
+        return _rows(self.connection.execute(sql, args), include_docs)
+
+
+def _table(name):
+    return 'view_' + name
+
+
+def function_version(function):
+    """
+    A hash of the code of a function and of the functions it uses through
+    its closure, so that a view is rebuilt when its map function changes.
+    """
+    sha = hashlib.sha1()
+    _hash_function(sha, function, set())
+    return sha.hexdigest()
+
+
+def _hash_function(sha, function, seen):
+    code = getattr(function, '__code__', None)
+    if code is None or code in seen:
+        return
+    seen.add(code)
+    _hash_code(sha, code)
+    for cell in function.__closure__ or ():
+        try:
+            _hash_function(sha, cell.cell_contents, seen)
+        except ValueError:
+            pass  # empty cell
+
+
+def _hash_code(sha, code):
+    sha.update(code.co_code)
+    sha.update(repr(code.co_names).encode('utf8'))
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _hash_code(sha, const)
+        elif isinstance(const, frozenset):
+            sha.update(repr(sorted(const, key=repr)).encode('utf8'))
+        else:
+            sha.update(repr(const).encode('utf8'))
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _rows(cursor, include_docs):
+    for row in cursor:
+        result = {
+            '_id': row[1],
+            'key': _tuples(json.loads(row[0])),
+            'value': json.loads(row[2]),
+        }
+        if include_docs:
+            result['doc'] = json.loads(row[3]) if row[3] is not None else None
+        yield result
+
+
+def _group(cursor, reduce_function, skip, limit):
+    count = 0
+    current = _missing
+    values = []
+    for raw_key, _, value in cursor:
+        if raw_key != current:
+            if current is not _missing:
+                if count >= (skip or 0):
+                    key = _tuples(json.loads(current))
+                    yield {'key': key, 'value': reduce_function([key] * len(values), values, False)}
+                count += 1
+                if limit is not None and count >= (skip or 0) + limit:
+                    return
+            current = raw_key
+            values = []
+        values.append(json.loads(value))
+
+    if current is not _missing and count >= (skip or 0):
+        key = _tuples(json.loads(current))
+        yield {'key': key, 'value': reduce_function([key] * len(values), values, False)}
+
+
+def _tuples(value):
+    if isinstance(value, list):
+        return tuple(_tuples(v) for v in value)
+    return value
+
+
+# KEY ENCODING
+##############
+#
+# None < False < True < numbers < strings < tuples/lists < any
+
+
+def encode_key(key):
+    return bytes(_encode(key))
+
+
+def _encode(key):
+    if key is any:
+        return b'\xff'
+    elif key is None:
+        return b'\x10'
+    elif key is False:
+        return b'\x20'
+    elif key is True:
+        return b'\x21'
+    elif isinstance(key, (int, float)):
+        bits = struct.unpack('>Q', struct.pack('>d', float(key)))[0]
+        if bits & (1 << 63):
+            bits = ~bits & 0xffffffffffffffff
+        else:
+            bits |= 1 << 63
+        return b'\x30' + struct.pack('>Q', bits)
+    elif isinstance(key, str):
+        return b'\x40' + key.encode('utf8').replace(b'\x00', b'\x00\xff') + b'\x00'
+    elif isinstance(key, (tuple, list)):
+        return b'\x50' + b''.join(_encode(k) for k in key) + b'\x00'
+    else:
+        raise TypeError('Can not use %s as a key' % type(key).__name__)
@@ -8,6 +8,15 @@ import socket
 import zmq
 
 from images7.config import Config, resolve_path, StorageType
+from images7.multi import ConnectionPool
+from images7.localfile import sync_pending
+from images7 import sqlitedb
+
+
+database_engines = {
+    'jsondb': jsondb.Database,
+    'sqlite': sqlitedb.Database,
+}
 
 
 def current_system() -> 'System':
@@ -42,137 +51,25 @@ class System:
         assert self.media_root is not None, 'Missing media root!'
         os.makedirs(self.media_root, exist_ok=True)
         logging.debug("Media root path: %s", self.media_root)
+        self.close_hooks.append(lambda: sync_pending(force=True))
 
     def setup_zmq(self):
         logging.debug("Setting up ZeroMQ context...")
         self.zmq_config = next((x for x in self.config.zmqs if x.server == self.hostname), None)
         assert self.zmq_config is not None, 'Missing zmq config for %s' % self.hostname
         self.zmq_context = zmq.Context(1)
+        self.zmq_pool = ConnectionPool(self.zmq_context)
+        self.close_hooks.append(self.zmq_pool.close)
         logging.debug("ZeroMQ context setup")
 
-    def zmq_req_lazy_pirate(self, channel, timeout=2500, retries=3):
-        endpoint = 'ipc://' + channel
-
-        logging.debug('Connecting to server...')
-        client = self.zmq_context.socket(zmq.REQ)
-        client.bind(endpoint)
-
-        poll = zmq.Poller()
-        poll.register(client, zmq.POLLIN)
-
-        reply = None
-        sequence = 0
-        retries_left = retries
-        while retries_left:
-            sequence += 1
-            request = str(sequence).encode('utf8')
-            logging.debug('Sending %i...', sequence)
-            client.send(request)
-
-            expect_reply = True
-            while expect_reply:
-                socks = dict(poll.poll(timeout))
-                if socks.get(client) == zmq.POLLIN:
-                    reply = client.recv()
-                    if not reply:
-                        break
-                    if int(reply) == sequence:
-                        # Server replied OK
-                        logging.debug('Server replied %i (good)', int(reply))
-                        retries_left = 0
-                        expect_reply = False
-                    else:
-                        logging.debug('Server replied %i (bad)', int(reply))
-                        #pass # bad server reply
-
-                else:
-                    # No reponse from server, retry...
-                    logging.debug('Closing down...')
-                    client.setsockopt(zmq.LINGER, 0)
-                    client.close()
-                    poll.unregister(client)
-                    retries_left -= 1
-                    if retries_left == 0:
-                        logging.debug('Give up!')
-                        break
-                    # Reconnecting
-                    logging.debug('Reconnect...')
-                    client = self.zmq_context.socket(zmq.REQ)
-                    client.connect(endpoint)
-                    poll.register(client, zmq.POLLIN)
-                    client.send(request)
-
-        return reply
-
-    def zmq_rep_lazy_pirate(self, channel, handler):
-        endpoint = 'ipc://' + channel
-
-        server = self.zmq_context.socket(zmq.REP)
-        server.connect(endpoint)
-
-        while True:
-            request = server.recv()
-            handler()
-            server.send(request)
-
-    def zmq_req_payload(self, channel, payload, timeout=2500, retries=3):
-        endpoint = 'ipc://' + channel
-
-        logging.debug('Connecting to %s...', endpoint)
-        client = self.zmq_context.socket(zmq.REQ)
-        client.bind(endpoint)
-
-        poll = zmq.Poller()
-        poll.register(client, zmq.POLLIN)
-
-        sequence = 0
-        retries_left = retries
-        while retries_left:
-            sequence += 1
-            request = [str(sequence).encode('utf8'), payload.to_json().encode('utf8')]
-            logging.debug('Sending %i...', sequence)
-            client.send_multipart(request)
-            logging.debug('Sent %i. Waiting.', sequence)
-
-            expect_reply = True
-            while expect_reply:
-                socks = dict(poll.poll(timeout))
-                if socks.get(client) == zmq.POLLIN:
-                    reply = client.recv_multipart()
-                    if not reply:
-                        break
-                    if int(reply[0]) == sequence:
-                        # Server replied OK
-                        logging.debug('Server replied %i (good)', int(reply))
-                        retries_left = 0
-                        expect_reply = False
-                    else:
-                        logging.debug('Server replied %i (bad)', int(reply))
-                        #pass # bad server reply
-
-                else:
-                    # No reponse from server, retry...
-                    logging.debug('Closing down...')
-                    client.setsockopt(zmq.LINGER, 0)
-                    client.close()
-                    poll.unregister(client)
-                    retries_left -= 1
-                    if retries_left == 0:
-                        logging.debug('Give up!')
-                        break
-                    # Reconnecting
-                    logging.debug('Reconnect...')
-                    client = context.socket(zmq.REQ)
-                    client.connect(endpoint)
-                    poll.register(client, zmq.POLLIN)
-                    client.send(request)
-
-        return reply
-
     def setup_database(self):
         db_config = next((x for x in self.config.databases if x.server == self.hostname), None)
         assert db_config is not None, 'Missing database config!'
         db_root = resolve_path(db_config.path)
+        self.db_root = db_root
+        Database = database_engines.get(db_config.engine)
+        assert Database is not None, 'Unknown database engine %s' % db_config.engine
+        logging.debug("Database engine: %s", db_config.engine)
 
         self.db = dict()
 
@@ -227,7 +124,7 @@ class System:
             for file in value.get('files', []):
                 yield file.get('reference'), None
 
-        entry = jsondb.Database(os.path.join(db_root, 'entry'))
+        entry = Database(os.path.join(db_root, 'entry'))
         entry.define('by_taken_ts', get_taken_ts_tuple)
         entry.define(
             'state_by_date',
@@ -253,24 +150,35 @@ class System:
         entry.define('by_file_reference', each_file_reference)
         self.db['entry'] = entry
 
-        file = jsondb.Database(os.path.join(db_root, 'file'))
+        file = Database(os.path.join(db_root, 'file'))
         file.define(
             'by_reference',
             lambda o: (o['reference'], None)
         )
+        file.define(
+            'by_fingerprint',
+            lambda o: (o['fingerprint'], None) if o.get('fingerprint') else None
+        )
         self.db['file'] = file
 
-        date = jsondb.Database(os.path.join(db_root, 'date'))
+        date = Database(os.path.join(db_root, 'date'))
         date.define(
             'by_date',
             lambda o: (o['_id'], None)
         )
         self.db['date'] = date
 
-        job = jsondb.Database(os.path.join(db_root, 'job'))
+        date_stats = Database(os.path.join(db_root, 'date_stats'))
+        date_stats.define(
+            'by_day',
+            lambda o: (tuple(o['period']), None) if len(o['period']) == 3 else None,
+        )
+        self.db['date_stats'] = date_stats
+
+        job = Database(os.path.join(db_root, 'job'))
         job.define(
             'by_state',
-            lambda o: ((o['state'], o['release'], o['priority']), None),
+            lambda o: ((o['state'], o['priority'], o['release']), None),
         )
         job.define(
             'by_updated',
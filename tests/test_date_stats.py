@@ -0,0 +1,49 @@
+import pytest
+
+from images7 import date
+from images7.system import current_system
+from images7.sqlitedb import Database
+
+
+class FakeSystem:
+    def __init__(self, path):
+        entry = Database(str(path / 'entry'))
+        entry.define(
+            'state_by_date',
+            lambda o: (o['metadata']['taken_ts'][:10], {'state': o['state']}),
+            lambda keys, values, rereduce: dict(
+                total=len(values),
+                **{v['state']: [w['state'] for w in values].count(v['state']) for v in values}
+            ),
+        )
+        date_stats = Database(str(path / 'date_stats'))
+        date_stats.define(
+            'by_day',
+            lambda o: (tuple(o['period']), None) if len(o['period']) == 3 else None,
+        )
+        self.db = {'entry': entry, 'date_stats': date_stats}
+
+
+def _entry(id, taken_ts, state='new'):
+    return {'_id': id, 'state': state, 'metadata': {'taken_ts': taken_ts}}
+
+
+@pytest.fixture
+def system(tmp_path, monkeypatch):
+    monkeypatch.setattr(current_system, 'system', FakeSystem(tmp_path))
+    monkeypatch.setattr(date, '_stats_ready', False)
+    return current_system.system
+
+
+def test_update_after_restart_before_read(system):
+    first = system.db['entry'].save(_entry('a', '2017-06-01T10:00:00'))
+    date.count_entry_change(None, first)
+    assert date.get_date_stats('2017-06-01').total == 1
+
+    date._stats_ready = False  # restart
+
+    second = system.db['entry'].save(_entry('b', '2017-06-01T11:00:00'))
+    date.count_entry_change(None, second)
+
+    assert date.get_date_stats('2017-06-01').total == 2
+    assert date.get_date_stats('2017').total == 2
@@ -18,7 +18,7 @@ $(function() {
                                     method: 'POST',
                                     success: function(data) {
                                         $.monitor(
-                                            'importer/status',
+                                            data.self_url,
                                             'importing',
                                             'scanning',
                                             'importing',